@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""Benchmarks the Nuvo class against the NV-E6G emulator
+
+Measures open() time (cold and from the cache file), getStatus() time,
+per-command latency and sustained commands per second.
+"""
+import argparse, logging, nuvo, os, statistics, tempfile, time
+from nuvo_emulator import NuvoEmulator
+
+def timed(func, *args):
+    """Returns how long func took in seconds"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def percentile(samples, pct):
+    """Returns the pct percentile of samples"""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+def report(name, samples):
+    """Prints latency statistics in milliseconds"""
+    ms = [s * 1000 for s in samples]
+    print(f"{name:24} {len(ms):6} {statistics.mean(ms):9.2f} {percentile(ms, 50):9.2f} "
+          f"{percentile(ms, 95):9.2f} {percentile(ms, 99):9.2f} {max(ms):9.2f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=200, help="commands per measurement")
+    parser.add_argument('--baud', type=int, default=57600, help="emulated baud rate")
+    parser.add_argument('--latency', type=float, default=0.002, help="emulated command processing time (s)")
+    parser.add_argument('--threaded', action='store_true', help="use the reader thread")
+    parser.add_argument('--pipeline', type=int, default=1, help="commands in flight")
+    parser.add_argument('--adaptive', action='store_true', help="measured reply deadlines instead of fixed sleeps")
+    parser.add_argument('--sleep-after', type=float, default=None, help="emulated idle time before the Nuvo sleeps (s)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with NuvoEmulator(baudrate=args.baud, latency=args.latency, sleepAfter=args.sleep_after) as emulator, \
+         tempfile.TemporaryDirectory() as tmp:
+        # Start with some Zones on so not every Zone is power cycled
+        for zone in (1, 2, 3, 4):
+            emulator.zones[zone]['power'] = True
+        cache = os.path.join(tmp, 'cache.json')
+
+        print(f"baud {args.baud}, latency {args.latency * 1000:.1f}ms, "
+              f"threaded {args.threaded}, pipeline {args.pipeline}, adaptive {args.adaptive}\n")
+        print(f"{'measurement':24} {'count':>6} {'mean ms':>9} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+
+        nv = nuvo.Nuvo(emulator.port, threaded=args.threaded, pipeline=args.pipeline, cache=cache,
+                       adaptive=args.adaptive)
+        report('open() cold', [timed(nv.open)])
+        nv.close()
+
+        nv = nuvo.Nuvo(emulator.port, threaded=args.threaded, pipeline=args.pipeline, cache=cache,
+                       adaptive=args.adaptive)
+        report('open() from cache', [timed(nv.open)])
+        report('getStatus()', [timed(nv.getStatus) for _ in range(3)])
+
+        zone = 3
+        commands = {
+            'setVol':     lambda i: nv.setVol(zone, 30 + i % 20),
+            'volUp':      lambda i: nv.volUp(zone),
+            'volDown':    lambda i: nv.volDown(zone),
+            'setSource':  lambda i: nv.setSource(zone, 1 + i % 6),
+            'toggleMute': lambda i: nv.toggleMute(zone),
+            'queryZone':  lambda i: nv.queryZone(zone),
+        }
+        for name, command in commands.items():
+            report(name, [timed(command, i) for i in range(args.n)])
+
+        start = time.perf_counter()
+        for i in range(args.n):
+            nv.sendCommand(f'Z{1 + i % 4}STATUS?')
+        elapsed = time.perf_counter() - start
+        print(f"\nsustained sendCommand:  {args.n / elapsed:9.1f} commands/s")
+
+        start = time.perf_counter()
+        nv.sendCommands([f'Z{1 + i % 4}STATUS?' for i in range(args.n)])
+        elapsed = time.perf_counter() - start
+        print(f"sustained sendCommands: {args.n / elapsed:9.1f} commands/s")
+        nv.close()
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+"""Micro-benchmark of Nuvo response parsing, per message type
+
+Usage: bench_parse.py [seconds per type]
+"""
+import logging, nuvo, sys, timeit
+
+# Lines as recorded from an NV-E6G, including the ones it sends that we don't understand
+lines = {
+    'Z':       [b'#Z1,ON,SRC1,VOL40,DND0,LOCK0\r\n',
+                b'#Z3,ON,SRC2,VOL53,DND0,LOCK0\r\n',
+                b'#Z11,ON,SRC6,MUTE,DND0,LOCK0\r\n',
+                b'#Z12,OFF\r\n'],
+    'ZCFG':    [b'#ZCFG1,ENABLE1,NAME"Living Room",SLAVETO0,GROUP0,SOURCES63,XSRC0,IR0,DND0,LOCKED0\r\n',
+                b'#ZCFG11,ENABLE1,NAME"Patio",SLAVETO10,GROUP0,SOURCES63,XSRC0,IR0,DND0,LOCKED0\r\n',
+                b'#ZCFG12,ENABLE0\r\n'],
+    'SCFG':    [b'#SCFG1,ENABLE1,NAME"MediaCenter",GAIN0,NUVONET0,SHORTNAME"MCE"\r\n',
+                b'#SCFG6,ENABLE0\r\n'],
+    'VER':     [b'#VER"NV-E6G FWv2.66 HWv0"\r\n'],
+    'ALLOFF':  [b'#ALLOFF\r\n'],
+    'unmatched': [b'#?\r\n',
+                  b'#Z1,ON,SRC9,VOL40,DND0,LOCK0\r\n',
+                  b'#ZCFG1,ENABLE1,NAME"Bad/Name",SLAVETO0\r\n',
+                  b'\r\n'],
+    'garbage': [b'\x00\xff\x13#Z\r\n',
+                b'Z1ON\r\n',
+                b'\xfe\xfe\xfe\r\n'],
+}
+
+def bench(func, sample, seconds):
+    """Returns lines per second that func handles, cycling through sample"""
+    def run(n):
+        for _ in range(n):
+            for line in sample:
+                func(line)
+    timer = timeit.Timer(lambda: run(1000))
+    number, elapsed = timer.autorange()
+    runs = max(1, int(seconds / elapsed * number))
+    elapsed = min(timer.repeat(repeat=3, number=runs))
+    return runs * 1000 * len(sample) / elapsed
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 0.2
+    logging.disable(logging.CRITICAL)
+
+    # Not opened, only used to apply events to its Sources and Zones
+    nv = nuvo.Nuvo(None)
+
+    print(f"{'message':10} {'parse lines/s':>14} {'parse+apply lines/s':>20}")
+    for msg, sample in lines.items():
+        parse = bench(nuvo.Nuvo.parse, sample, seconds)
+        apply = bench(nv.parseLine, sample, seconds)
+        print(f"{msg:10} {parse:14,.0f} {apply:20,.0f}")
+
+    # A keypad flood or ALLOFF as one read from the port, framed and parsed as a batch
+    burst = b''.join(lines['Z'] * 3)
+    count = len(lines['Z']) * 3
+    frame = bench(nv.frames, [burst], seconds) * count
+    batch = bench(lambda data: nv.parseLines(nv.frames(data)), [burst], seconds) * count
+    print(f"\n{'burst':10} {'frame lines/s':>14} {'frame+parse lines/s':>20}")
+    print(f"{'Z x' + str(count):10} {frame:14,.0f} {batch:20,.0f}")
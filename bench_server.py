@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+"""Load-tests nuvo_server.py against the NV-E6G emulator
+
+Starts the server on the emulator's port and drives a mix of /nuvo commands
+from many concurrent clients, then reports requests per second and latency
+per command. Commands for a Zone are checked against the emulator: the status
+each one returns and the emulated Nuvo must both match what the command should
+have done, so a reply given to the wrong request makes the test fail.
+"""
+import argparse, collections, http.client, json, os, random, subprocess, sys, tempfile, threading, time
+from bench_nuvo import report
+from nuvo_emulator import NuvoEmulator
+
+# Commands that act on a Zone, one client at a time per Zone so the outcome is known
+zoneCommands = ('status', 'setvol', 'volup', 'pwr')
+
+def parseMix(text):
+    """Returns {command:weight} from command=weight,..."""
+    mix = {}
+    for item in text.split(','):
+        command, sep, weight = item.partition('=')
+        mix[command.strip()] = float(weight) if sep else 1.0
+    unknown = set(mix) - set(zoneCommands) - {'getzonelabels'}
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown commands {', '.join(sorted(unknown))}")
+    return mix
+
+def startServer(emulator, port, workers, tmp):
+    """Starts nuvo_server.py on the emulator in tmp and waits until it serves the status, returns the process"""
+    env = dict(os.environ, NUVO_PORTS=emulator.port, NUVO_WORKERS=str(workers))
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nuvo_server.py')
+    proc = subprocess.Popen([sys.executable, server, str(port)], cwd=tmp, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"nuvo_server.py exited with {proc.returncode}, see {tmp}/nuvo_server.log")
+        try:
+            conn = http.client.HTTPConnection('localhost', port, timeout=5)
+            conn.request('GET', '/nuvo')
+            rsp = conn.getresponse()
+            rsp.read()
+            conn.close()
+            # 503 until the Nuvo is open with its status loaded
+            if rsp.status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("nuvo_server.py did not answer")
+
+class LoadTest:
+    """Clients sending a weighted mix of commands, checking the Zone commands' outcome"""
+
+    # Seconds a volup has to reach the Nuvo
+    settle = 2
+
+    def __init__(self, emulator, port, mix, zones):
+        self.emulator   = emulator
+        self.port       = port
+        self.commands   = list(mix)
+        self.weights    = [mix[command] for command in self.commands]
+        self.zones      = zones
+        self.zoneLocks  = {zone:threading.Lock() for zone in zones}
+        self.history    = {zone:collections.deque(maxlen=4) for zone in zones}
+        self.names      = {str(zone):emulator.zones[zone]['name'] for zone in emulator.zones}
+        self.latencies  = collections.defaultdict(list)
+        self.errors     = collections.Counter()
+        self.mismatches = []
+        self.lock       = threading.Lock()
+        self.stopping   = threading.Event()
+
+    def truth(self, zone):
+        """Returns the emulated Zone's (power, volume) as the server reports them"""
+        z = self.emulator.zones[zone]
+        return ("on" if z['power'] else "off", 79 - z['volume'])
+
+    def mismatch(self, text):
+        """Notes a response that does not match the Nuvo"""
+        with self.lock:
+            self.mismatches.append(text)
+
+    def request(self, conn, command, zone = None, value = None):
+        """Sends a /nuvo request, returns (seconds, parsed JSON) or None after counting the error"""
+        path = f'/nuvo?command={command}'
+        if zone is not None:
+            path += f'&zone={zone}'
+        if value is not None:
+            path += f'&value={value}'
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path)
+            rsp = conn.getresponse()
+            body = rsp.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            with self.lock:
+                self.errors[(command, type(e).__name__)] += 1
+            return None
+        elapsed = time.perf_counter() - start
+        if rsp.status != 200:
+            with self.lock:
+                self.errors[(command, rsp.status)] += 1
+            return None
+        return elapsed, json.loads(body)
+
+    def zoneCommand(self, conn, command):
+        """Sends a command for a random Zone and checks what it did, returns its time or None"""
+        zone = random.choice(self.zones)
+        with self.zoneLocks[zone]:
+            power, volume = self.truth(zone)
+            if command == 'volup' and (power == "off" or volume == 79):
+                # Its volume would be sent later without changing anything, and could not be waited for
+                return None
+            value = None
+            if command == 'setvol':
+                value = random.randint(0, 79)
+                if power == "on":
+                    volume = value
+            elif command == 'volup':
+                volume += 1
+            elif command == 'pwr':
+                value = 1 if random.random() < 0.75 else 0
+                power = "on" if value else "off"
+            result = self.request(conn, command, zone, value)
+            if result is None:
+                return None
+            elapsed, status = result
+            expected = (power, volume)
+            reported = (status[str(zone)]['power'], status[str(zone)]['vol'])
+            if command == 'volup':
+                # The server sends the steps of coalesce seconds as one volume after answering
+                deadline = time.monotonic() + self.settle
+                while self.truth(zone) != expected and time.monotonic() < deadline:
+                    time.sleep(0.01)
+                reported = expected
+            actual = self.truth(zone)
+            # An off Zone keeps whatever volume it had before
+            if power == "off":
+                expected, actual, reported = expected[:1], actual[:1], reported[:1]
+            if actual != expected or reported != expected:
+                self.mismatch(f"{command} zone {zone} {value}: expected {expected}, "
+                              f"server reported {reported}, Nuvo has {actual}, "
+                              f"after {' '.join(self.history[zone]) or 'nothing'}")
+            self.history[zone].append(f"{command}({value})" if value is not None else command)
+        return elapsed
+
+    def labels(self, conn):
+        """Gets the Zone names and checks them, returns its time or None"""
+        result = self.request(conn, 'getzonelabels')
+        if result is None:
+            return None
+        elapsed, names = result
+        if names != self.names:
+            self.mismatch(f"getzonelabels: got {names}")
+        return elapsed
+
+    def client(self):
+        """Client thread: sends commands over one connection until stopped"""
+        conn = http.client.HTTPConnection('localhost', self.port, timeout=30)
+        while not self.stopping.is_set():
+            command = random.choices(self.commands, self.weights)[0]
+            if command == 'getzonelabels':
+                elapsed = self.labels(conn)
+            else:
+                elapsed = self.zoneCommand(conn, command)
+            if elapsed is not None:
+                with self.lock:
+                    self.latencies[command].append(elapsed)
+        conn.close()
+
+    def run(self, clients, duration):
+        """Runs the clients for duration seconds, returns the seconds they actually ran"""
+        threads = [threading.Thread(target=self.client, name=f'client-{k}', daemon=True) for k in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        self.stopping.set()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def checkStatus(self):
+        """Checks the status the server reports for every Zone against the emulator,
+        giving the workers' snapshot up to settle seconds to catch up"""
+        deadline = time.monotonic() + self.settle
+        while True:
+            conn = http.client.HTTPConnection('localhost', self.port, timeout=30)
+            conn.request('GET', '/nuvo')
+            status = json.loads(conn.getresponse().read())
+            conn.close()
+            wrong = []
+            for zone in self.zones:
+                actual = self.truth(zone)
+                reported = (status[str(zone)]['power'], status[str(zone)]['vol'])
+                if actual[0] == "off":
+                    actual, reported = actual[:1], reported[:1]
+                if reported != actual:
+                    wrong.append(f"final status zone {zone}: server reported {reported}, Nuvo has {actual}")
+            if not wrong or time.monotonic() > deadline:
+                break
+            time.sleep(0.1)
+        for text in wrong:
+            self.mismatch(text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=16, help="concurrent clients")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--mix', type=parseMix, default='status=40,getzonelabels=20,setvol=20,volup=10,pwr=10',
+                        help="command=weight,... of status (for a Zone), getzonelabels, setvol, volup and pwr")
+    parser.add_argument('--port', type=int, default=18080, help="HTTP port for the server")
+    parser.add_argument('--workers', type=int, default=0, help="server worker processes, see nuvo_replica.py")
+    parser.add_argument('--baud', type=int, default=57600, help="emulated baud rate")
+    parser.add_argument('--latency', type=float, default=0.002, help="emulated command processing time (s)")
+    args = parser.parse_args()
+
+    with NuvoEmulator(baudrate=args.baud, latency=args.latency) as emulator, \
+         tempfile.TemporaryDirectory() as tmp:
+        for z in emulator.zones.values():
+            z['power'] = True
+            z['volume'] = 39
+        server = startServer(emulator, args.port, args.workers, tmp)
+        try:
+            test = LoadTest(emulator, args.port, args.mix, list(emulator.zones))
+            elapsed = test.run(args.clients, args.duration)
+            test.checkStatus()
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"{args.clients} clients for {elapsed:.1f}s, workers {args.workers}, "
+          f"baud {args.baud}, latency {args.latency * 1000:.1f}ms\n")
+    print(f"{'command':24} {'count':>6} {'mean ms':>9} {'p50 ms':>9} "
+          f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for command in test.commands:
+        if test.latencies[command]:
+            report(command, test.latencies[command])
+    print()
+    total = 0
+    for command in test.commands:
+        count = len(test.latencies[command])
+        total += count
+        print(f"{command + ' requests/s':24} {count / elapsed:9.1f}")
+    print(f"{'total requests/s':24} {total / elapsed:9.1f}")
+    for (command, error), count in sorted(test.errors.items(), key=str):
+        print(f"errors: {command} {error}: {count}")
+    if test.mismatches:
+        print(f"\nFAILED: {len(test.mismatches)} responses did not match the Nuvo")
+        for text in test.mismatches[:10]:
+            print(f"  {text}")
+        sys.exit(1)
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+"""Checks nuvo_mqtt.py against the NV-E6G emulator, with a local stand-in for the broker
+
+Starts the bridge while the broker is down, which must not stop the Nuvo, then
+brings the broker up and checks the retained state, commands, keypad changes and
+the status going offline. Needs neither paho-mqtt nor a broker.
+
+Usage: check_mqtt.py
+"""
+import logging, sys, threading, time
+import nuvo, nuvo_mqtt
+from nuvo_emulator import NuvoEmulator
+
+class LocalBroker:
+    """Retained messages and subscriptions of the clients connected to it"""
+
+    def __init__(self):
+        self.up       = threading.Event()
+        self.lock     = threading.Lock()
+        self.retained = {}
+        self.clients  = []
+
+    def matches(self, pattern, topic):
+        """Whether topic matches a subscription with + wildcards"""
+        pattern, topic = pattern.split('/'), topic.split('/')
+        return len(pattern) == len(topic) and all(p in ('+', t) for p, t in zip(pattern, topic))
+
+    def publish(self, topic, payload, retain):
+        """Keeps a retained message and passes it on to the subscribers"""
+        with self.lock:
+            if retain:
+                self.retained[topic] = payload
+            clients = [client for client in self.clients
+                       if any(self.matches(pattern, topic) for pattern in client.subscriptions)]
+        for client in clients:
+            client.deliver(topic, payload)
+
+class Message:
+    """What on_message gets"""
+
+    def __init__(self, topic, payload):
+        self.topic   = topic
+        self.payload = payload.encode('utf-8')
+
+class LocalClient:
+    """The part of a paho-mqtt Client that NuvoMqtt uses, on a LocalBroker"""
+
+    def __init__(self, broker):
+        self.broker        = broker
+        self.subscriptions = []
+        self.connected     = False
+        self.stopping      = threading.Event()
+        self.thread        = None
+        self.will          = None
+        self.on_connect    = None
+        self.on_message    = None
+
+    def will_set(self, topic, payload, retain = False):
+        self.will = (topic, payload, retain)
+
+    def connect_async(self, host, port, keepalive):
+        self.address = (host, port)
+
+    def loop_start(self):
+        self.thread = threading.Thread(target=self.loop, name='mqtt-client', daemon=True)
+        self.thread.start()
+
+    def loop(self):
+        """Network thread: connects once the broker is up"""
+        while not self.stopping.is_set():
+            if self.broker.up.wait(0.05):
+                with self.broker.lock:
+                    self.broker.clients.append(self)
+                self.connected = True
+                self.on_connect(self, None, {}, 0)
+                break
+
+    def loop_stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def disconnect(self):
+        self.connected = False
+        with self.broker.lock:
+            if self in self.broker.clients:
+                self.broker.clients.remove(self)
+
+    def subscribe(self, topic):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload, qos = 0, retain = False):
+        # Like paho when not connected, the message is lost
+        if self.connected:
+            self.broker.publish(topic, payload, retain)
+
+    def deliver(self, topic, payload):
+        self.on_message(self, None, Message(topic, payload))
+
+def waitFor(condition, seconds = 2):
+    """Returns whether condition() became true within seconds"""
+    deadline = time.monotonic() + seconds
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    failures = []
+
+    def check(name, ok):
+        print(f"{name:48} {'ok' if ok else 'FAILED'}")
+        if not ok:
+            failures.append(name)
+
+    with NuvoEmulator(latency=0.002) as emulator:
+        emulator.zones[2]['power'] = True
+        nv = nuvo.Nuvo(emulator.port, threaded=True, pipeline=4, adaptive=True)
+        nv.open()
+        broker = LocalBroker()
+        bridge = nuvo_mqtt.NuvoMqtt(nv, client=LocalClient(broker))
+        bridge.start()
+        check("start returns while the broker is down", not broker.retained)
+        check("Nuvo still answers", nv.setVol(2, 30) is True)
+
+        broker.up.set()
+        check("online once the broker is up", waitFor(lambda: broker.retained.get('nuvo/status') == 'online'))
+        check("retained Zone state", waitFor(lambda: broker.retained.get('nuvo/zone/2/volume') == '30'
+                                             and broker.retained.get('nuvo/zone/2/power') == 'on'))
+
+        broker.publish('nuvo/zone/2/set/volume', '40', False)
+        check("set/volume reaches the Nuvo", waitFor(lambda: emulator.zones[2]['volume'] == 79 - 40))
+        check("set/volume is published", waitFor(lambda: broker.retained.get('nuvo/zone/2/volume') == '40'))
+        broker.publish('nuvo/zone/3/set/power', 'on', False)
+        check("set/power reaches the Nuvo", waitFor(lambda: emulator.zones[3]['power']))
+
+        emulator.keypad(5, power=True)
+        check("keypad change is published", waitFor(lambda: broker.retained.get('nuvo/zone/5/power') == 'on'))
+
+        bridge.stop()
+        check("offline after stop", broker.retained.get('nuvo/status') == 'offline')
+        nv.close()
+
+    if failures:
+        print(f"\nFAILED: {len(failures)} checks")
+        sys.exit(1)
@@ -1,5 +1,8 @@
 #!/bin/sh
 mkdir -v /usr/local/bin/nuvo_server
 cp -v nuvo.py /usr/local/bin/nuvo_server/
+cp -v nuvo_manager.py /usr/local/bin/nuvo_server/
+cp -v nuvo_mqtt.py /usr/local/bin/nuvo_server/
+cp -v nuvo_replica.py /usr/local/bin/nuvo_server/
 cp -v nuvo_server.py /usr/local/bin/nuvo_server/
 cp -v nuvo_server /etc/init.d/
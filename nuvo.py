@@ -1,58 +1,512 @@
-import re, serial, time, logging, sys
+import re, serial, time, logging, sys, threading, collections, json, os, queue, itertools, bisect, math, select, struct
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeout
+
+# Events parsed from lines sent by the Nuvo, key matches them to commands
+class VerEvent(collections.namedtuple('VerEvent', 'device fw hw')):
+    """#VER: device, firmware and hardware versions"""
+    __slots__ = ()
+    key = ('VER', None)
+
+class AllOffEvent(collections.namedtuple('AllOffEvent', '')):
+    """#ALLOFF: all Zones were turned off"""
+    __slots__ = ()
+    key = ('ALLOFF', None)
+
+class ZoneEvent(collections.namedtuple('ZoneEvent', 'zone power source volume muted dnd locked')):
+    """#Z: Zone status, everything but zone and power is None when off or not reported"""
+    __slots__ = ()
+    @property
+    def key(self):
+        return ('Z', self.zone)
+
+class SourceCfgEvent(collections.namedtuple('SourceCfgEvent', 'source enabled name gain nuvonet shortname')):
+    """#SCFG: Source configuration, everything but source and enabled is None when disabled"""
+    __slots__ = ()
+    @property
+    def key(self):
+        return ('SCFG', self.source)
+
+class ZoneCfgEvent(collections.namedtuple('ZoneCfgEvent', 'zone enabled name slaveto group sources xsrc ir dnd locked')):
+    """#ZCFG: Zone configuration, everything but zone and enabled is None when disabled"""
+    __slots__ = ()
+    @property
+    def key(self):
+        return ('ZCFG', self.zone)
+
+class Metrics:
+    """Counters, gauges and histograms, rendered in the Prometheus text format"""
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.lock   = threading.Lock()
+        self.help   = {}
+        self.values = {}
+        self.gauges = {}
+
+    def counter(self, name, help):
+        """Declares a counter"""
+        self.help[name] = ('counter', help)
+
+    def histogram(self, name, help):
+        """Declares a histogram of seconds"""
+        self.help[name] = ('histogram', help)
+
+    def gauge(self, name, help, func):
+        """Declares a gauge whose value is func()"""
+        self.help[name] = ('gauge', help)
+        self.gauges[name] = func
+
+    def inc(self, name, labels = (), value = 1):
+        """Adds to a counter, labels is a tuple of (label, value) pairs"""
+        key = (name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, value, labels = ()):
+        """Adds a value to a histogram"""
+        key = (name, labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Count per bucket, then +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        """Returns {(name, labels): value}, histograms as {'count', 'sum', 'buckets':{le:count}}"""
+        with self.lock:
+            values = {key:(list(value) if isinstance(value, list) else value) for key, value in self.values.items()}
+        snapshot = {}
+        for key, value in values.items():
+            if isinstance(value, list):
+                cumulative = list(itertools.accumulate(value[:-1]))
+                value = {'count':cumulative[-1], 'sum':value[-1],
+                         'buckets':dict(zip(self.buckets + (float('inf'),), cumulative))}
+            snapshot[key] = value
+        for name, func in self.gauges.items():
+            snapshot[(name, ())] = func()
+        return snapshot
+
+    @staticmethod
+    def labelText(labels):
+        """Returns {a="1",b="2"} for the labels"""
+        if not labels:
+            return ''
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+    @staticmethod
+    def render(sources):
+        """Returns the Prometheus text for [(Metrics, {label:value} added to all of its samples), ...]"""
+        families = {}
+        for metrics, extra in sources:
+            extra = tuple(extra.items())
+            for (name, labels), value in metrics.snapshot().items():
+                kind, help = metrics.help[name]
+                lines = families.setdefault(name, (kind, help, []))[2]
+                labels = extra + labels
+                if kind != 'histogram':
+                    lines.append(f'{name}{Metrics.labelText(labels)} {value}')
+                    continue
+                for le, count in value['buckets'].items():
+                    le = '+Inf' if le == float('inf') else le
+                    lines.append(f'{name}_bucket{Metrics.labelText(labels + (("le", le),))} {count}')
+                lines.append(f'{name}_sum{Metrics.labelText(labels)} {value["sum"]}')
+                lines.append(f'{name}_count{Metrics.labelText(labels)} {value["count"]}')
+        text = []
+        for name, (kind, help, lines) in sorted(families.items()):
+            text.append(f'# HELP {name} {help}')
+            text.append(f'# TYPE {name} {kind}')
+            text.extend(lines)
+        return '\n'.join(text) + '\n'
+
+class ChangeLog:
+    """The latest changes to the status of the Zones, numbered so a client can ask for the ones it missed
+
+    Each entry is the fields of one Zone's status that changed, so the status
+    a client got when it last resynced plus the entries after it is the status now.
+    """
+
+    def __init__(self, size, status):
+        """status returns the {zone:{field:value}} to log the changes of"""
+        self.lock    = threading.Lock()
+        self.entries = collections.deque(maxlen=size)
+        self.status  = status
+        self.last    = None
+        self.seq     = 0
+        self.floor   = 0
+
+    def record(self):
+        """Logs the Zones whose status changed since the last time, and starts over
+        when the Zones themselves changed, returns the latest sequence number"""
+        with self.lock:
+            status = self.status()
+            if self.last is None or status.keys() != self.last.keys():
+                self.seq += 1
+                self.floor = self.seq
+                self.entries.clear()
+            else:
+                for zone, fields in status.items():
+                    last = self.last[zone]
+                    changed = {k:v for k, v in fields.items() if last.get(k) != v}
+                    if changed:
+                        self.seq += 1
+                        self.entries.append((self.seq, 'zone', zone, changed))
+            self.last = {zone:dict(fields) for zone, fields in status.items()}
+            return self.seq
+
+    def reset(self):
+        """Forgets the changes, for when the state was replaced wholesale"""
+        with self.lock:
+            self.last = None
+        self.record()
+
+    def since(self, seq):
+        """Returns (latest sequence number, [(seq, kind, num, changes), ...] after seq),
+        with None for the changes if they are no longer all here and the client must resync"""
+        with self.lock:
+            oldest = self.entries[0][0] if self.entries else self.seq + 1
+            if seq < self.floor or seq < oldest - 1 or seq > self.seq:
+                return self.seq, None
+            return self.seq, [entry for entry in self.entries if entry[0] > seq]
+
+class Recorder:
+    """Appends what goes over the serial port to a transcript file
+
+    Each record is the time.monotonic() it happened as a double, a kind byte
+    (W written, R read, S a session started with the time.time() as its data),
+    the data's length as an unsigned short, all little endian, then the data.
+    """
+
+    header = struct.Struct('<dcH')
+
+    # Seconds between flushes, so a crash loses little without a write to disk each record
+    flushEvery = 1
+
+    def __init__(self, path):
+        self.lock    = threading.Lock()
+        self.file    = open(path, 'ab')
+        self.flushed = time.monotonic()
+        self.write(b'S', repr(time.time()).encode('ascii'))
+
+    def write(self, kind, data):
+        """Appends a record"""
+        now = time.monotonic()
+        with self.lock:
+            self.file.write(self.header.pack(now, kind, len(data)) + data)
+            if now - self.flushed > self.flushEvery:
+                self.file.flush()
+                self.flushed = now
+
+    def close(self):
+        """Flushes and closes the file"""
+        with self.lock:
+            self.file.close()
+
+    @classmethod
+    def read(cls, path):
+        """Yields (time, kind, data) for the records of a transcript file"""
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(cls.header.size)
+                if len(header) < cls.header.size:
+                    return
+                when, kind, size = cls.header.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    # Cut off while it was written
+                    return
+                yield when, kind, data
+
+class Command:
+    """A command for the Nuvo, finished with the result of parsing its reply"""
+    __slots__ = ('cmd', 'key', 'fut', 'priority', 'deadline', 'replaces', 'replacedBy', 'superseded', 'sent',
+                 'tries')
+
+    def __init__(self, cmd, key, fut, priority = 0, deadline = None, replaces = None):
+        self.cmd        = cmd
+        self.key        = key
+        self.fut        = fut
+        self.priority   = priority
+        self.deadline   = deadline
+        self.replaces   = replaces
+        self.replacedBy = None
+        self.superseded = []
+        self.sent       = None
+        self.tries      = 0
+
+    def finish(self, result):
+        """Completes the command and the older ones it replaced"""
+        for fut in [self.fut] + self.superseded:
+            try:
+                if not fut.done():
+                    fut.set_result(result)
+            except InvalidStateError:
+                # Its waiter gave up on it in the meantime
+                pass
+
+# State of the Sources and Zones, updated from the events
+class State:
+    __slots__ = ()
+
+    def asdict(self):
+        """Returns the fields as a dictionary, e.g. for the cache file"""
+        return {k:getattr(self, k) for k in self.__slots__}
+
+    def update(self, fields):
+        """Sets the fields from a dictionary, ignoring unknown ones"""
+        for k, v in fields.items():
+            if k in self.__slots__:
+                setattr(self, k, v)
+
+class SourceState(State):
+    """A Source's configuration from #SCFG"""
+    __slots__ = ('enabled', 'name', 'gain', 'nuvonet', 'shortname')
+
+    def __init__(self):
+        self.enabled   = False
+        self.name      = None
+        self.gain      = None
+        self.nuvonet   = None
+        self.shortname = None
+
+class ZoneState(State):
+    """A Zone's configuration from #ZCFG and status from #Z"""
+    __slots__ = ('enabled', 'name', 'slaveto', 'group', 'sources', 'xsrc', 'ir', 'dnd', 'locked',
+                 'power', 'source', 'volume', 'muted')
+
+    def __init__(self):
+        self.enabled = False
+        self.name    = None
+        self.slaveto = None
+        self.group   = None
+        self.sources = None
+        self.xsrc    = None
+        self.ir      = None
+        self.dnd     = None
+        self.locked  = None
+        self.power   = None
+        self.source  = None
+        self.volume  = None
+        self.muted   = None
 
 class Nuvo:
     
     numSources = 6
     numZones = 12
+    cacheVersion = 1
+
+    # Command priorities, user actions go ahead of background refreshes
+    userPriority = 0
+    backgroundPriority = 1
+    queueSize = 64
+    queueTimeout = 5
+
+    # Adaptive timing: reply deadlines before any latency is measured, at the least, and resends
+    initialTimeout = 0.1
+    minTimeout     = 0.02
+    retries        = 2
+
+    # Reconciler: seconds until each kind of status is worth asking for again, and
+    # the bytes a query and its reply take on the link
+    staleAfter = {'Z':30, 'ZCFG':600, 'SCFG':600}
+    queryBytes = {'Z':45, 'ZCFG':110, 'SCFG':85}
+
+    # Seconds between attempts to open the Nuvo, doubling from the first to the second
+    backoff = (1, 60)
+
+    # Changes kept for Nuvo.changesSince
+    changeLogSize = 1024
+
+    # Bytes without a line end after which the receive buffer is garbage, the longest message is ~110
+    maxFrame = 512
 
     #VER"DEV FWvx.xx HWvx"
-    verre = re.compile(r'#VER"(?P<device>[A-Za-z0-9-]+) '
-                       r'FWv(?P<fw>[0-9.]+) '
-                       r'HWv(?P<hw>[0-9]+)"')
+    verre = re.compile(rb'#VER"(?P<device>[A-Za-z0-9-]+) '
+                       rb'FWv(?P<fw>[0-9.]+) '
+                       rb'HWv(?P<hw>[0-9]+)"')
 
     #ALLOFF
-    alloffre = re.compile(r'#ALLOFF')
+    alloffre = re.compile(rb'#ALLOFF')
     
     #SCFGx,ENABLE0
     #SCFGx,ENABLE1,NAME"Source Name",GAINx,NUVONETx,SHORTNAME"XYZ"
-    scfgre = re.compile(r'#SCFG(?P<source>[1-6]),'
-                        r'ENABLE(?P<enabled>[01])(?:,'
-                        r'NAME"(?P<name>[A-Za-z0-9\'_ ]+)",'
-                        r'GAIN(?P<gain>[0-9]+),'
-                        r'NUVONET(?P<nuvonet>[01]),'
-                        r'SHORTNAME"(?P<shortname>[A-Z]+)"|)')
+    scfgre = re.compile(rb'#SCFG(?P<source>[1-6]),'
+                        rb'ENABLE(?P<enabled>[01])(?:,'
+                        rb'NAME"(?P<name>[A-Za-z0-9\'_ ]+)",'
+                        rb'GAIN(?P<gain>[0-9]+),'
+                        rb'NUVONET(?P<nuvonet>[01]),'
+                        rb'SHORTNAME"(?P<shortname>[A-Z]+)"|)')
 
     #ZCFGx,ENABLE0
     #ZCFGx,ENABLE1,NAME"Zone Name",SLAVETOx,GROUPx,SOURCESx,XSRCx,IRx,DNDx,LOCKEDx
-    zcfgre = re.compile(r'#ZCFG(?P<zone>[0-9]+),'
-                        r'ENABLE(?P<enabled>[01])(?:,'
-                        r'NAME"(?P<name>[A-Za-z0-9\'_ ]+)",'
-                        r'SLAVETO(?P<slaveto>[0-9]+),'
-                        r'GROUP(?P<group>[0-9]+),'
-                        r'SOURCES(?P<sources>[0-9]+),'
-                        r'XSRC(?P<xsrc>[01]),'
-                        r'IR(?P<ir>[012]),'
-                        r'DND(?P<dnd>[0-7]),'
-                        r'LOCKED(?P<locked>[01])|)')
+    zcfgre = re.compile(rb'#ZCFG(?P<zone>[0-9]+),'
+                        rb'ENABLE(?P<enabled>[01])(?:,'
+                        rb'NAME"(?P<name>[A-Za-z0-9\'_ ]+)",'
+                        rb'SLAVETO(?P<slaveto>[0-9]+),'
+                        rb'GROUP(?P<group>[0-9]+),'
+                        rb'SOURCES(?P<sources>[0-9]+),'
+                        rb'XSRC(?P<xsrc>[01]),'
+                        rb'IR(?P<ir>[012]),'
+                        rb'DND(?P<dnd>[0-7]),'
+                        rb'LOCKED(?P<locked>[01])|)')
     #Zx,OFF
     #Zx,ON,SRCx,VOLx,DNDx,LOCKx
-    zre = re.compile(r'#Z(?P<zone>[0-9]+),'
-                     r'(?P<power>ON|OFF)(?:,'
-                     r'SRC(?P<source>[1-6]),'
-                     r'(?:VOL|)(?P<volume>(?:[0-9]+|MUTE)),'
-                     r'DND(?P<dnd>[01]),'
-                     r'LOCK(?P<locked>[01])|)')
-
-    def __init__(self, port, to = 1):
+    zre = re.compile(rb'#Z(?P<zone>[0-9]+),'
+                     rb'(?P<power>ON|OFF)(?:,'
+                     rb'SRC(?P<source>[1-6]),'
+                     rb'(?:VOL|)(?P<volume>(?:[0-9]+|MUTE)),'
+                     rb'DND(?P<dnd>[01]),'
+                     rb'LOCK(?P<locked>[01])|)')
+
+    #Key used to match a command to the reply it causes
+    #*Z3VOL+ -> ('Z', 3) <- #Z3,ON,SRC1,VOL40,DND0,LOCK0
+    keyre = re.compile(r'(VER|ALLOFF|ZCFG|SCFG|Z)([0-9]*)')
+
+    #Commands that set a Zone's state outright, a newer one replaces a queued older one
+    #*Z3VOL40 -> (3, 'VOL')
+    replacere = re.compile(r'Z([0-9]+)(VOL(?=[0-9])|SRC|ON$|OFF$|MUTEON|MUTEOFF)')
+    replacekinds = {'ON':'PWR', 'OFF':'PWR', 'MUTEON':'MUTE', 'MUTEOFF':'MUTE'}
+
+    #Command type for the metrics: *Z3VOL40 -> VOL, *Z3VOL+ -> VOL+, *ZCFG3STATUS? -> ZCFG
+    cmdtypere = re.compile(r'(?:(ZCFG|SCFG)|Z)[0-9]+([A-Z]*[+-]?)')
+
+    @staticmethod
+    def parseVer(line):
+        m = Nuvo.verre.match(line)
+        if m:
+            return VerEvent(*(g.decode('ascii') for g in m.groups()))
+        return None
+
+    @staticmethod
+    def parseAllOff(line):
+        if Nuvo.alloffre.match(line):
+            return AllOffEvent()
+        return None
+
+    @staticmethod
+    def parseZone(line):
+        m = Nuvo.zre.match(line)
+        if m is None:
+            return None
+        zone, power, source, volume, dnd, locked = m.groups()
+        if source is None:
+            return ZoneEvent(int(zone), power.decode('ascii'), None, None, None, None, None)
+        if volume == b'MUTE':
+            return ZoneEvent(int(zone), 'ON', int(source), None, True, dnd == b'1', locked == b'1')
+        # Convert from Nuvo's 0 = Max, 79 = Min format
+        return ZoneEvent(int(zone), 'ON', int(source), 79 - int(volume), False, dnd == b'1', locked == b'1')
+
+    @staticmethod
+    def parseSourceCfg(line):
+        m = Nuvo.scfgre.match(line)
+        if m is None:
+            return None
+        source, enabled, name, gain, nuvonet, shortname = m.groups()
+        if name is None:
+            return SourceCfgEvent(int(source), enabled == b'1', None, None, None, None)
+        return SourceCfgEvent(int(source), enabled == b'1', name.decode('ascii'), int(gain),
+                              nuvonet == b'1', shortname.decode('ascii'))
+
+    @staticmethod
+    def parseZoneCfg(line):
+        m = Nuvo.zcfgre.match(line)
+        if m is None:
+            return None
+        zone, enabled, name, slaveto, group, sources, xsrc, ir, dnd, locked = m.groups()
+        if name is None:
+            return ZoneCfgEvent(int(zone), enabled == b'1', None, None, None, None, None, None, None, None)
+        return ZoneCfgEvent(int(zone), enabled == b'1', name.decode('ascii'), int(slaveto) or None,
+                            int(group), int(sources), xsrc == b'1', int(ir), int(dnd), locked == b'1')
+
+    # Parser for each message, by the two characters after the '#'
+    parsers = {b'VE':parseVer.__func__, b'AL':parseAllOff.__func__,
+               b'SC':parseSourceCfg.__func__, b'ZC':parseZoneCfg.__func__,
+               **dict.fromkeys([b'Z%d' % d for d in range(1, 10)], parseZone.__func__)}
+
+    @classmethod
+    def parse(cls, line):
+        """Parses a raw line from the Nuvo into an event, returns None if not understood"""
+        parser = cls.parsers.get(line[1:3])
+        if parser is None or line[:1] != b'#':
+            return None
+        return parser(line)
+
+    def __init__(self, port, to = 1, threaded = False, pipeline = 1, cache = None, coalesce = 0, adaptive = False,
+                 reconcile = 0, reconnect = False, record = None):
         logging.debug("init...")
         self.asleep       = True
         self.ser          = serial.Serial()
         self.ser.port     = port
         self.ser.baudrate = 57600
         self.ser.timeout  = to
-        self.sources      = {k+1:{'enabled':False, 'name':None} for k in range(self.numSources)}
-        self.zones        = {k+1:{'enabled':False, 'name':None, 'slaveto':None, 'power':None, 'source':None, 'volume':None, 'muted':None} for k in range(self.numZones)}
+        self.sources      = {k+1:SourceState() for k in range(self.numSources)}
+        self.zones        = {k+1:ZoneState() for k in range(self.numZones)}
         self.zonelist     = {k+1:{'power':None, 'input':None, 'input_name':None, 'vol':None, 'mute':None} for k in range(self.numZones)}
+        self.threaded     = threaded
+        self.reader       = None
+        self.reading      = False
+        self.lock         = threading.Condition()
+        self.pending      = []
+        self.scheduler    = None
+        self.cmdQueue     = queue.PriorityQueue(self.queueSize)
+        self.queued       = {}
+        self.latest       = {}
+        self.seq          = itertools.count()
+        self.pipeline     = pipeline
+        self.cache        = cache
+        self.cached       = None
+        self.firmware     = None
+        self.verifier     = None
+        self.listeners    = []
+        self.version      = 0
+        self.statusVersion = None
+        self.statusCache  = None
+        self.changes      = ChangeLog(self.changeLogSize, self.status)
+        self.coalesce     = coalesce
+        self.steps        = {}
+        self.volTargets   = {}
+        self.stepLock     = threading.Lock()
+        self.adaptive     = adaptive
+        self.latencies    = {}
+        self.lastReply    = 0.0
+        self.rxbuf        = bytearray()
+        self.record       = record
+        self.recorder     = None
+        self.reconcile    = reconcile
+        self.reconciler   = None
+        self.stopping     = threading.Event()
+        self.confirmed    = {}
+        self.asked        = {}
+        self.reconnect    = reconnect
+        self.connected    = False
+        self.ready        = False
+        self.connections  = 0
+        self.connector    = None
+        self.closing      = threading.Event()
+        self.indexZones()
+        self.metrics      = Metrics()
+        self.metrics.histogram('nuvo_command_seconds', "Time from writing a command to parsing its reply")
+        self.metrics.counter('nuvo_reply_timeouts_total', "Commands that got no reply in time")
+        self.metrics.counter('nuvo_readline_timeouts_total', "Reads that timed out while replies were pending")
+        self.metrics.counter('nuvo_messages_total', "Messages parsed, by type")
+        self.metrics.counter('nuvo_unmatched_lines_total', "Lines from the Nuvo that were not understood")
+        self.metrics.counter('nuvo_discarded_bytes_total', "Bytes from the Nuvo outside of any message")
+        self.metrics.counter('nuvo_wakeups_total', "Times the Nuvo had to be woken up")
+        self.metrics.counter('nuvo_commands_dropped_total', "Commands dropped from the queue, by reason")
+        self.metrics.counter('nuvo_retries_total', "Commands sent again after their reply was overdue")
+        self.metrics.counter('nuvo_reconcile_queries_total', "Status queries sent by the reconciler, by type")
+        self.metrics.counter('nuvo_link_lost_total', "Times the serial port failed")
+        self.metrics.counter('nuvo_connect_attempts_total', "Times the Nuvo was opened, by result")
+        self.metrics.gauge('nuvo_connected', "1 while the Nuvo is open and answering", lambda: int(self.connected))
+        self.metrics.gauge('nuvo_ready', "1 once the Nuvo is open and its status loaded", lambda: int(self.ready))
+        self.metrics.gauge('nuvo_queue_depth', "Commands waiting in the scheduler queue", self.cmdQueue.qsize)
+        self.metrics.gauge('nuvo_commands_in_flight', "Commands written and waiting for their reply",
+                           lambda: len(self.pending))
+        if reconnect and not threaded:
+            # Without the reader a user's thread owns the port, the connect thread would race it
+            logging.warning("init: reconnect needs threaded, a failed link on %s stays down until open() is called again", port)
 
     def __enter__(self):
         logging.debug("enter...")
@@ -61,140 +515,887 @@ class Nuvo:
         
     def __exit__(self, type, value, traceback):
         logging.debug("exit...")
-        self.ser.close()
+        self.close()
         
     def open(self):
         """Opens serial port, and updates status of all Sources and Zones"""
         logging.debug("open...")
+        # Replies to what was in flight on an earlier link will not come
+        self.failPending()
+        if self.record is not None and self.recorder is None:
+            self.recorder = Recorder(self.record)
         self.ser.open()
         self.ser.flushInput()
+        # A line the last link was cut off in the middle of would be glued onto the first reply
+        self.rxbuf.clear()
+        # It may have been power cycled since it was last open
+        self.asleep = True
+        if self.threaded:
+            self.startReader()
         if self.sendCommand(f'VER') == True:
-            self.getStatus()
+            self.connected = True
+            self.metrics.inc('nuvo_connect_attempts_total', (('result', 'open'),))
+            if self.connections:
+                # Reopened: what we know is newer than the cache file
+                self.startVerify()
+            elif self.loadCache():
+                self.startVerify()
+            else:
+                self.getStatus()
+                self.saveCache()
+            if not self.connected:
+                # The port failed while loading the status
+                self.disconnect()
+                return False
+            # Only now is there a status to serve
+            self.ready = True
+            self.connections += 1
+            if self.reconcile:
+                self.startReconciler()
             return True
         else:
-            self.ser.close()
+            self.metrics.inc('nuvo_connect_attempts_total', (('result', 'no reply'),))
+            self.disconnect()
             return False
-    
-    def sendCommand(self, cmd):
-        """Handles actually sending the command and parsing the response"""
-        # Parse all waiting messages
-        while self.ser.in_waiting:
-            logging.debug("sendCommand: Parsing waiting message")
-            self.parseResponse()
-        
-        # Wake up Nuvo if needed    
+
+    def close(self):
+        """Stops the reader thread and closes the serial port"""
+        logging.debug("close...")
+        self.closing.set()
+        if self.connector is not None and self.connector is not threading.current_thread():
+            self.connector.join()
+            self.connector = None
+        if self.verifier is not None:
+            self.verifier.join()
+            self.verifier = None
+        # Only save once the cache was loaded or written for this Nuvo
+        if self.cached is not None:
+            self.saveCache()
+        self.disconnect()
+        # Nothing will send what is still queued
+        while not self.cmdQueue.empty():
+            self.cmdQueue.get_nowait()[2].finish(False)
+        self.queued.clear()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def disconnect(self):
+        """Stops the threads that use the port and closes it, keeping what is queued"""
+        self.connected = False
+        self.ready = False
+        self.stopReconciler()
+        self.stopReader()
+        self.ser.close()
+        self.failPending()
+
+    def failPending(self):
+        """Finishes the commands waiting for a reply with False"""
+        with self.lock:
+            inflight, self.pending = self.pending, []
+            self.lock.notify_all()
+        for command in inflight:
+            command.finish(False)
+
+    def connect(self):
+        """Opens the Nuvo in the background, retrying with exponential backoff until it answers"""
+        self.closing.clear()
+        self.startConnector()
+
+    def startConnector(self):
+        """Starts the thread that opens the Nuvo unless it is already running"""
+        with self.lock:
+            if self.connector is not None and self.connector.is_alive():
+                return
+            self.connector = threading.Thread(target=self.connectLoop, name='nuvo-connect', daemon=True)
+            self.connector.start()
+
+    def connectLoop(self):
+        """Connect thread: opens the Nuvo, waiting longer after each failure, until it is open or closed"""
+        delay = self.backoff[0]
+        while not self.closing.is_set():
+            # What the failed link had queued stays queued for the new one
+            self.disconnect()
+            try:
+                if self.open():
+                    logging.info("connect: Nuvo on %s is open", self.ser.port)
+                    return
+            except (serial.SerialException, OSError) as e:
+                logging.warning("connect: Could not open %s: %s", self.ser.port, e)
+                self.metrics.inc('nuvo_connect_attempts_total', (('result', 'error'),))
+                self.disconnect()
+            logging.warning("connect: Nuvo on %s is not answering, retrying in %ss", self.ser.port, delay)
+            self.closing.wait(delay)
+            delay = min(2 * delay, self.backoff[1])
+
+    def linkLost(self, error):
+        """Called when the port fails: replays what was in flight once the Nuvo is open again"""
+        with self.lock:
+            if not self.connected:
+                return
+            self.connected = False
+            self.ready = False
+            self.reading = False
+            inflight, self.pending = self.pending, []
+            self.lock.notify_all()
+        logging.error("linkLost: Serial port %s failed: %s", self.ser.port, error)
+        self.metrics.inc('nuvo_link_lost_total')
+        queued = []
+        while not self.cmdQueue.empty():
+            queued.append(self.cmdQueue.get_nowait()[2])
+        # Only what users asked for is replayed, the rest is refreshed once the Nuvo is open again.
+        # Requeued in reverse as each one goes ahead of the ones before it
+        for command in reversed(inflight + queued):
+            # What was in flight may or may not have reached the Nuvo, so only if that is safe
+            replay = self.threaded and command.priority == self.userPriority and \
+                     (command in queued or self.idempotent(command.cmd))
+            if not (replay and self.requeue(command)):
+                command.finish(False)
+        # Only threaded, see __init__
+        if self.reconnect and self.threaded and not self.closing.is_set():
+            self.startConnector()
+
+    def cacheSnapshot(self):
+        """Returns the cache file contents for the current Sources and Zones"""
+        return {'version':self.cacheVersion, 'firmware':self.firmware,
+                'sources':{k:v.asdict() for k, v in self.sources.items()},
+                'zones':{k:v.asdict() for k, v in self.zones.items()}}
+
+    def loadCache(self):
+        """Loads Sources and Zones from the cache file, returns False if missing or stale"""
+        if self.cache is None:
+            return False
+        try:
+            with open(self.cache) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.info("loadCache: Could not read %s: %s", self.cache, e)
+            return False
+        if snapshot.get('version') != self.cacheVersion or snapshot.get('firmware') != self.firmware:
+            logging.info("loadCache: %s is for a different device or firmware", self.cache)
+            return False
+        # JSON turns the Source and Zone numbers into strings
+        for source, state in snapshot['sources'].items():
+            if int(source) in self.sources:
+                self.sources[int(source)].update(state)
+        for zone, state in snapshot['zones'].items():
+            if int(zone) in self.zones:
+                self.zones[int(zone)].update(state)
+        self.indexZones()
+        self.version += 1
+        self.changes.reset()
+        self.notify('reset', None, {})
+        self.cached = json.dumps(self.cacheSnapshot(), sort_keys=True)
+        logging.debug("loadCache: Loaded %s", self.cache)
+        return True
+
+    def saveCache(self):
+        """Writes Sources and Zones to the cache file if they changed"""
+        if self.cache is None:
+            return
+        cached = json.dumps(self.cacheSnapshot(), sort_keys=True)
+        if cached == self.cached:
+            return
+        try:
+            with open(self.cache + '.tmp', 'w') as f:
+                f.write(cached)
+            os.replace(self.cache + '.tmp', self.cache)
+            self.cached = cached
+            logging.debug("saveCache: Saved %s", self.cache)
+        except OSError as e:
+            logging.warning("saveCache: Could not write %s: %s", self.cache, e)
+
+    def startVerify(self):
+        """Checks the cached Sources and Zones against the Nuvo, in the background if threaded"""
+        if self.reader is None:
+            self.verify()
+            return
+        self.verifier = threading.Thread(target=self.verify, name='nuvo-verify', daemon=True)
+        self.verifier.start()
+
+    def verify(self):
+        """Refreshes what may have changed since the cache was saved, then saves it"""
+        logging.debug("verify...")
+        self.refresh()
+        self.saveCache()
+
+    def startReader(self):
+        """Starts the threads that own the port: the scheduler writes every command
+        and the reader reads and parses every message from the Nuvo"""
+        logging.debug("startReader...")
+        self.reading = True
+        self.reader = threading.Thread(target=self.readLoop, name='nuvo-reader', daemon=True)
+        self.reader.start()
+        self.scheduler = threading.Thread(target=self.scheduleLoop, name='nuvo-scheduler', daemon=True)
+        self.scheduler.start()
+
+    def stopReader(self):
+        """Stops the reader and scheduler threads if they are running"""
+        if self.reader is None:
+            return
+        logging.debug("stopReader...")
+        self.reading = False
+        for thread in (self.reader, self.scheduler):
+            if thread is not threading.current_thread():
+                thread.join()
+        self.reader = None
+        self.scheduler = None
+
+    def readLoop(self):
+        """Reader thread: parses lines as they arrive until stopped"""
+        while self.reading:
+            try:
+                lines = self.readLines()
+            except (serial.SerialException, OSError) as e:
+                self.linkLost(e)
+                break
+            # Nothing arrived before the timeout
+            if lines is None:
+                if self.pending:
+                    self.metrics.inc('nuvo_readline_timeouts_total')
+                continue
+            try:
+                self.parseLines(lines)
+            except Exception:
+                # One bad message must not stop the reader
+                logging.exception("readLoop: Could not parse %s", lines)
+
+    def startReconciler(self):
+        """Starts the thread that keeps the Sources and Zones fresh in the background"""
+        if self.reader is None:
+            logging.warning("startReconciler: Needs the reader thread, not reconciling")
+            return
+        if self.reconciler is not None:
+            return
+        logging.debug("startReconciler...")
+        self.stopping.clear()
+        self.reconciler = threading.Thread(target=self.reconcileLoop, name='nuvo-reconciler', daemon=True)
+        self.reconciler.start()
+
+    def stopReconciler(self):
+        """Stops the reconciler thread if it is running"""
+        if self.reconciler is None:
+            return
+        logging.debug("stopReconciler...")
+        self.stopping.set()
+        self.reconciler.join()
+        self.reconciler = None
+
+    def stalest(self):
+        """Returns (age / staleAfter, key) for the Source or Zone status that most needs asking for"""
+        now = time.monotonic()
+        keys  = [('SCFG', source) for source in self.sources.keys()]
+        keys += [('ZCFG', zone) for zone in self.zones.keys()]
+        keys += [('Z', zone) for zone, state in self.zones.items() if state.enabled is not False]
+        # Confirmed by any reply, also unsolicited ones, or asked for without a reply
+        return max(((now - max(self.confirmed.get(key, -math.inf), self.asked.get(key, -math.inf)))
+                    / self.staleAfter[key[0]], key) for key in keys)
+
+    def reconcileLoop(self):
+        """Reconciler thread: asks for the stalest status one at a time, within its share of the link"""
+        byteTime = 10 / self.ser.baudrate
+        while not self.stopping.is_set():
+            # Never in the way of other commands, and a sleeping Nuvo tells us when a keypad wakes it
+            if self.cmdQueue.qsize() or self.pending or self.asleep:
+                self.stopping.wait(self.minTimeout)
+                continue
+            overdue, key = self.stalest()
+            if overdue < 1:
+                self.stopping.wait(min(self.ser.timeout, (1 - overdue) * self.staleAfter[key[0]]))
+                continue
+            kind, num = key
+            logging.debug("reconcileLoop: Asking for %s%s", kind, num)
+            self.metrics.inc('nuvo_reconcile_queries_total', (('type', kind),))
+            self.asked[key] = time.monotonic()
+            self.sendCommand(f'{kind}{num}STATUS?', self.backgroundPriority)
+            self.stopping.wait(self.queryBytes[kind] * byteTime * (1 / self.reconcile - 1))
+
+    def msgKey(self, cmd):
+        """Returns the key matching a command to its reply, or None"""
+        m = self.keyre.match(cmd)
+        if m:
+            return (m.group(1), int(m.group(2)) if m.group(2) else None)
+        return None
+
+    def wake(self):
+        """Wakes up the Nuvo if needed"""
         if self.asleep == True:
             logging.debug("sendCommand: Waking Nuvo...")
+            self.metrics.inc('nuvo_wakeups_total')
             self.ser.write(b'\r')
-            time.sleep(0.05)
+            if self.recorder is not None:
+                self.recorder.write(b'W', b'\r')
+            if self.adaptive:
+                self.wakeProbe()
+            else:
+                time.sleep(0.05)
             self.asleep = False
 
-        # Send Command to Nuvo
-        logging.debug("sendCommand: Sending *%s", cmd)
-        self.ser.write(b'*' + bytes(cmd, 'ascii') + b'\r')
-        
-        # Parse response from Nuvo
-        return self.parseResponse()
+    def wakeProbe(self):
+        """Sends VER until the Nuvo replies, so the command after it is not lost while it wakes up"""
+        # Called with the lock held, by the scheduler or the caller that owns the port
+        for attempt in range(1 + self.retries):
+            command = Command('VER', self.msgKey('VER'), Future())
+            # Its reply comes before the reply to the command that is waking the Nuvo
+            self.pending.insert(0, command)
+            self.writeCommand('VER')
+            command.sent = time.monotonic()
+            deadline = command.sent + self.replyTimeout('VER')
+            if self.threaded:
+                self.lock.wait_for(command.fut.done, deadline - time.monotonic())
+            else:
+                while not command.fut.done() and time.monotonic() < deadline:
+                    self.parseLines(self.readLines(deadline - time.monotonic()) or [])
+            if command.fut.done():
+                logging.debug("wake: Nuvo replied to VER %d", attempt + 1)
+                return True
+            if command in self.pending:
+                self.pending.remove(command)
+        logging.warning("wake: No reply from the Nuvo")
+        return False
 
-    def parseResponse(self):
-        """Parses Nuvo response"""
-        # Read line from serial
-        rsp = self.ser.readline().decode('ascii').rstrip()
+    def readLines(self, timeout = None):
+        """Reads all the bytes waiting, or the next ones within timeout (by default the port's),
+        returns the lines they completed or None if nothing arrived"""
+        if timeout is None:
+            data = self.ser.read(self.ser.in_waiting or 1)
+        else:
+            # Waits on the port itself, setting ser.timeout would reconfigure it twice per read
+            if not self.ser.in_waiting and not select.select([self.ser.fileno()], [], [], max(0, timeout))[0]:
+                return None
+            data = self.ser.read(self.ser.in_waiting or 1)
+        if not data:
+            return None
+        if self.recorder is not None:
+            self.recorder.write(b'R', data)
+        return self.frames(data)
 
-        # Parse it
-        m = self.verre.match(rsp)
-        if m:
-            logging.debug("parseResponse: #VER match %s", rsp)
-            if m.group('device') == 'NV-E6G':
-                logging.debug("parseRespones: Device is Nuvo E6G")
-                return True
-            else:
-                logging.error("parseResponse: Device is not Nuvo E6G")
-                return False
+    def frames(self, data):
+        """Adds bytes from the Nuvo to the receive buffer, returns the lines they completed from their last '#'"""
+        buf = self.rxbuf
+        buf += data
+        end = buf.rfind(b'\n')
+        if end < 0:
+            if len(buf) > self.maxFrame:
+                # No line end for too long, keep only what may be the start of a message
+                start = max(buf.rfind(b'#'), 0)
+                self.metrics.inc('nuvo_discarded_bytes_total', value=start or len(buf))
+                del buf[:start or len(buf)]
+            return []
+        # One copy out of the buffer for all the lines, the rest stays for the next read
+        with memoryview(buf) as view:
+            lines = bytes(view[:end]).split(b'\n')
+        del buf[:end + 1]
+        frames = []
+        discarded = 0
+        for line in lines:
+            # From the last '#', the start of a message cut off by a lost link or a reset is dropped
+            start = line.rfind(b'#')
+            if start < 0:
+                # Blank lines, or noise such as from a Nuvo waking up
+                discarded += len(line.strip())
+                continue
+            if start:
+                discarded += start
+                line = line[start:]
+            frames.append(line)
+        if discarded:
+            self.metrics.inc('nuvo_discarded_bytes_total', value=discarded)
+        return frames
 
-        m = self.alloffre.match(rsp)
+    def cmdType(self, cmd):
+        """Returns the type of a command for the metrics, e.g. VOL for *Z3VOL40"""
+        m = self.cmdtypere.match(cmd)
         if m:
-            logging.debug("parseResponse: #ALLOFF match %s", rsp)
-            for zone in self.zones.keys():
-                self.zones[zone]['power'] = 'OFF'
-            self.asleep = True
-            return True
-        
-        m = self.zre.match(rsp)
+            return m.group(1) or m.group(2)
+        return cmd
+
+    def replyTimeout(self, cmd):
+        """Returns how long to wait for a command's reply, from the latencies measured for its type"""
+        estimate = self.latencies.get(self.cmdType(cmd))
+        if estimate is None:
+            return min(self.initialTimeout, self.ser.timeout)
+        mean, deviation = estimate
+        # Twice the mean as the Nuvo's replies vary with their length, not only with the link
+        return min(self.ser.timeout, max(self.minTimeout, 2 * mean + 4 * deviation))
+
+    def learnLatency(self, cmd, latency):
+        """Adds a measured reply latency to the moving mean and deviation for the command's type"""
+        kind = self.cmdType(cmd)
+        estimate = self.latencies.get(kind)
+        if estimate is None:
+            self.latencies[kind] = (latency, latency / 2)
+            return
+        mean, deviation = estimate
+        self.latencies[kind] = (0.875 * mean + 0.125 * latency, 0.75 * deviation + 0.25 * abs(mean - latency))
+
+    def idempotent(self, cmd):
+        """Returns True if sending a command twice does the same as sending it once"""
+        return cmd.endswith('?') or cmd in ('VER', 'ALLOFF') or self.replaceKey(cmd) is not None
+
+    def writeCommand(self, cmd):
+        """Writes a command to the Nuvo"""
+        logging.debug("sendCommand: Sending *%s", cmd)
+        data = b'*' + bytes(cmd, 'ascii') + b'\r'
+        self.ser.write(data)
+        if self.recorder is not None:
+            self.recorder.write(b'W', data)
+
+    def replaceKey(self, cmd):
+        """Returns what a command sets outright, e.g. (3, 'VOL'), or None"""
+        m = self.replacere.match(cmd)
         if m:
-            logging.debug("parseResponse: #Z match %s", rsp)
-            zone = int(m.group('zone'))
-            self.zones[zone]['power'] = m.group('power')
-            if m.group('power') == 'ON':
-                self.zones[zone]['source'] = int(m.group('source'))
-                if m.group('volume') == 'MUTE':
-                    self.zones[zone]['muted'] = True
+            return (int(m.group(1)), self.replacekinds.get(m.group(2), m.group(2)))
+        return None
+
+    def queueCommand(self, cmd, priority = userPriority, deadline = None):
+        """Queues a command, returns the Command whose Future is completed with its result
+
+        The scheduler drops the command if it is still queued deadline seconds from now
+        or if a newer command replaces it, e.g. a newer volume for the same Zone."""
+        deadline = time.monotonic() + (self.queueTimeout if deadline is None else deadline)
+        command = Command(cmd, self.msgKey(cmd), Future(), priority, deadline)
+        if self.scheduler is None:
+            if self.threaded or not self.ser.is_open:
+                # Only the scheduler writes when threaded, without it the link is down or still opening
+                command.finish(False)
+                return command
+            # No scheduler, the caller owns the port
+            with self.lock:
+                self.pending.append(command)
+                self.wake()
+                self.writeCommand(cmd)
+                command.sent = time.monotonic()
+            return command
+        if not self.reading:
+            # The port failed, nothing sends it until the Nuvo is open again
+            command.finish(False)
+            return command
+        command.replaces = self.replaceKey(cmd)
+        with self.lock:
+            older = self.queued.get(command.replaces)
+            if older is not None:
+                logging.debug("queueCommand: *%s replaces *%s", cmd, older.cmd)
+                older.replacedBy = command
+                command.superseded = [older.fut] + older.superseded
+            if command.replaces is not None:
+                self.queued[command.replaces] = command
+                self.latest[command.replaces] = command
+        try:
+            self.cmdQueue.put_nowait((priority, next(self.seq), command))
+        except queue.Full:
+            logging.warning("queueCommand: Queue full, dropping *%s", cmd)
+            self.metrics.inc('nuvo_commands_dropped_total', (('reason', 'full'),))
+            with self.lock:
+                if self.queued.get(command.replaces) is command:
+                    del self.queued[command.replaces]
+            command.finish(False)
+        return command
+
+    def scheduleLoop(self):
+        """Scheduler thread: writes queued commands by priority, keeping up to pipeline in flight"""
+        while self.reading:
+            try:
+                command = self.cmdQueue.get(timeout=self.ser.timeout)[2]
+            except queue.Empty:
+                continue
+            with self.lock:
+                if self.queued.get(command.replaces) is command:
+                    del self.queued[command.replaces]
+                if command.replacedBy is not None:
+                    self.metrics.inc('nuvo_commands_dropped_total', (('reason', 'replaced'),))
+                    continue
+                if command.fut.done():
+                    continue
+                if time.monotonic() > command.deadline:
+                    logging.warning("scheduleLoop: *%s expired in the queue", command.cmd)
+                    self.metrics.inc('nuvo_commands_dropped_total', (('reason', 'expired'),))
+                    command.finish(False)
+                    continue
+                while len(self.pending) >= self.pipeline and self.reading:
+                    self.lock.wait(self.ser.timeout)
+                if not self.reading:
+                    # Keep it for when the Nuvo is open again
+                    self.requeue(command)
+                    break
+                self.pending.append(command)
+                try:
+                    self.wake()
+                    self.writeCommand(command.cmd)
+                    command.sent = time.monotonic()
+                except (serial.SerialException, OSError) as e:
+                    # It was not sent, so it is safe to replay whatever it is
+                    self.pending.remove(command)
+                    self.requeue(command)
+                    self.linkLost(e)
+                    break
+
+    def waitResponse(self, command):
+        """Waits for a queued command's reply, returns False on timeout"""
+        if self.adaptive:
+            return self.waitAdaptive(command)
+        try:
+            if self.threaded:
+                # It may have to wait in the queue until its deadline first
+                return command.fut.result(max(0, command.deadline - time.monotonic()) + self.ser.timeout)
+            # No reader thread, parse replies here until ours arrives
+            deadline = time.monotonic() + self.ser.timeout
+            while not command.fut.done() and time.monotonic() < deadline:
+                lines = self.readLines()
+                if lines is None:
+                    self.metrics.inc('nuvo_readline_timeouts_total')
                 else:
-                    self.zones[zone]['volume'] = 79 - int(m.group('volume'))
-                    self.zones[zone]['muted'] = False
-            return True
-        
-        m = self.scfgre.match(rsp)
-        if m:
-            logging.debug("parseResponse: #SCFG match %s", rsp)
-            source = int(m.group('source'))
-            if m.group('enabled') == '1':
-                self.sources[source]['enabled'] = True
+                    self.parseLines(lines)
+            return command.fut.result(0)
+        except FutureTimeout:
+            return self.noReply(command)
+
+    def noReply(self, command):
+        """Gives up on a command's reply, returns False"""
+        with self.lock:
+            command.fut.cancel()
+            if command in self.pending:
+                self.pending.remove(command)
+                self.lock.notify()
+        logging.warning("waitResponse: No reply to *%s", command.cmd)
+        self.metrics.inc('nuvo_reply_timeouts_total', (('command', self.cmdType(command.cmd)),))
+        return False
+
+    def waitAdaptive(self, command):
+        """Waits for a command's reply until its measured deadline, sending it again if that is safe"""
+        while not command.fut.done():
+            now = time.monotonic()
+            if command.sent is None:
+                # Still queued, the scheduler finishes it if it expires there
+                if now > command.deadline + self.ser.timeout:
+                    break
+                wait = self.replyTimeout(command.cmd)
             else:
-                self.sources[source]['enabled'] = False
-            self.sources[source]['name'] = m.group('name')
-            return True
+                wait = self.replyDeadline(command) - now
+                if wait <= 0:
+                    if self.retryCommand(command):
+                        continue
+                    break
+            if self.threaded:
+                try:
+                    command.fut.result(wait)
+                except FutureTimeout:
+                    pass
+            else:
+                lines = self.readLines(wait)
+                if lines is None:
+                    self.metrics.inc('nuvo_readline_timeouts_total')
+                else:
+                    self.parseLines(lines)
+        if command.fut.done():
+            return command.fut.result()
+        return self.noReply(command)
 
-        m = self.zcfgre.match(rsp)
-        if m:
-            logging.debug("parseResponse: #ZCFG match %s", rsp)
-            zone = int(m.group('zone'))
-            if m.group('enabled') == '1':
-                self.zones[zone]['enabled'] = True
+    def replyDeadline(self, command):
+        """Returns when a written command's reply is overdue, allowing for the replies ahead of it"""
+        with self.lock:
+            ahead = self.pending.index(command) if command in self.pending else 0
+        # The Nuvo answers in order, so its time for this one starts after the last reply
+        return max(command.sent, self.lastReply) + self.replyTimeout(command.cmd) * (ahead + 1)
+
+    def retryCommand(self, command):
+        """Sends a command whose reply is overdue again if that is safe, returns True if it was"""
+        if command.tries >= self.retries or not self.idempotent(command.cmd):
+            return False
+        with self.lock:
+            if command.fut.done():
+                return True
+            # Never undo a newer command for the same setting
+            if command.replaces is not None and self.latest.get(command.replaces) is not command:
+                return False
+            if command in self.pending:
+                self.pending.remove(command)
+                self.lock.notify()
+            command.tries += 1
+            logging.debug("retryCommand: Resending *%s", command.cmd)
+            self.metrics.inc('nuvo_retries_total', (('command', self.cmdType(command.cmd)),))
+            # It may have gone to sleep, make sure it is awake before sending it again
+            self.asleep = True
+            if self.scheduler is None:
+                self.pending.append(command)
+                self.wake()
+                self.writeCommand(command.cmd)
+                command.sent = time.monotonic()
+                return True
+        return self.requeue(command)
+
+    def requeue(self, command):
+        """Queues a command again ahead of the others at its priority, returns False if the queue is full"""
+        command.sent = None
+        command.deadline = time.monotonic() + self.queueTimeout
+        try:
+            self.cmdQueue.put_nowait((command.priority, -next(self.seq), command))
+        except queue.Full:
+            return False
+        return True
+
+    def completeCommand(self, key, result):
+        """Completes the oldest pending command that the reply belongs to"""
+        with self.lock:
+            for command in self.pending:
+                if command.key == key:
+                    self.pending.remove(command)
+                    self.lock.notify()
+                    break
             else:
-                self.zones[zone]['enabled'] = False
-            self.zones[zone]['name'] = m.group('name')
-            if m.group('slaveto') != '0':
-                self.zones[zone]['slaveto'] = int(m.group('slaveto'))
+                return
+        now = time.monotonic()
+        if command.sent is not None:
+            self.metrics.observe('nuvo_command_seconds', now - command.sent,
+                                 (('command', self.cmdType(command.cmd)),))
+            # A resent command's reply may be to either send
+            if command.tries == 0:
+                self.learnLatency(command.cmd, now - max(command.sent, self.lastReply))
+        self.lastReply = now
+        command.finish(result)
+
+    def sendCommand(self, cmd, priority = userPriority, deadline = None):
+        """Handles actually sending the command and parsing the response"""
+        return self.sendCommands([cmd], priority, deadline)[0]
+
+    def sendCommands(self, cmds, priority = userPriority, deadline = None):
+        """Sends commands keeping up to pipeline of them in flight, returns their results in order"""
+        results = []
+        try:
+            # Parse all waiting messages, unless the reader thread owns the port
+            if not self.threaded:
+                while self.ser.in_waiting:
+                    logging.debug("sendCommand: Parsing waiting messages")
+                    self.parseLines(self.readLines())
+
+            # Replies are matched back to their command by zone or source number
+            inflight = collections.deque()
+            for cmd in cmds:
+                if len(inflight) >= self.pipeline:
+                    results.append(self.waitResponse(inflight.popleft()))
+                inflight.append(self.queueCommand(cmd, priority, deadline))
+            while inflight:
+                results.append(self.waitResponse(inflight.popleft()))
+        except (serial.SerialException, OSError) as e:
+            # Without the reader thread the port fails here
+            self.linkLost(e)
+            results += [False] * (len(cmds) - len(results))
+        return results
+
+    def parseResponse(self):
+        """Parses Nuvo response"""
+        # Read line from serial
+        return self.parseLine(self.ser.readline())
+
+    def parseLines(self, lines):
+        """Parses a batch of lines from the Nuvo"""
+        for line in lines:
+            self.parseLine(line)
+
+    def parseLine(self, rsp):
+        """Parses a line from the Nuvo and completes any command waiting on it"""
+        event = self.parse(rsp)
+        if event is None:
+            logging.warning("parseResponse: No match %s", rsp)
+            self.metrics.inc('nuvo_unmatched_lines_total')
+            return False
+        self.metrics.inc('nuvo_messages_total', (('type', type(event).__name__),))
+        result = self.appliers[type(event)](self, event)
+        if result and event.key[1] is not None:
+            self.confirmed[event.key] = time.monotonic()
+        if self.pending:
+            self.completeCommand(event.key, result)
+        return result
+
+    def applyVer(self, event):
+        """Records the device and firmware, returns True if it is an E6G"""
+        logging.debug("parseResponse: #VER match %s", event)
+        self.firmware = event._asdict()
+        if event.device == 'NV-E6G':
+            logging.debug("parseRespones: Device is Nuvo E6G")
             return True
-        
-        logging.warning("parseResponse: No match %s", rsp)
-        return False
+        else:
+            logging.error("parseResponse: Device is not Nuvo E6G")
+            return False
+
+    def applyAllOff(self, event):
+        """Turns off all Zones"""
+        logging.debug("parseResponse: #ALLOFF match")
+        now = time.monotonic()
+        for zone in self.zones.keys():
+            self.update('zone', zone, self.zones[zone], {'power':'OFF'})
+            self.confirmed[('Z', zone)] = now
+        self.asleep = True
+        return True
+
+    def applyZone(self, event):
+        """Updates a Zone's status"""
+        logging.debug("parseResponse: #Z match %s", event)
+        if event.zone not in self.zones:
+            logging.warning("parseResponse: Zone %s invalid", event.zone)
+            return False
+        changes = {'power':event.power}
+        if event.source is not None:
+            changes['source'] = event.source
+            changes['muted'] = event.muted
+            if not event.muted:
+                changes['volume'] = event.volume
+        self.update('zone', event.zone, self.zones[event.zone], changes)
+        return True
+
+    def applySourceCfg(self, event):
+        """Updates a Source's configuration"""
+        logging.debug("parseResponse: #SCFG match %s", event)
+        self.update('source', event.source, self.sources[event.source],
+                    {'enabled':event.enabled, 'name':event.name, 'gain':event.gain,
+                     'nuvonet':event.nuvonet, 'shortname':event.shortname})
+        return True
+
+    def applyZoneCfg(self, event):
+        """Updates a Zone's configuration"""
+        logging.debug("parseResponse: #ZCFG match %s", event)
+        if event.zone not in self.zones:
+            logging.warning("parseResponse: Zone %s invalid", event.zone)
+            return False
+        changed = self.update('zone', event.zone, self.zones[event.zone],
+                              {'enabled':event.enabled, 'name':event.name, 'slaveto':event.slaveto,
+                               'group':event.group, 'sources':event.sources, 'xsrc':event.xsrc,
+                               'ir':event.ir, 'dnd':event.dnd, 'locked':event.locked})
+        if 'slaveto' in changed or 'group' in changed:
+            self.indexZones()
+        return True
+
+    # How each event updates the Sources and Zones
+    appliers = {ZoneEvent:applyZone, AllOffEvent:applyAllOff, ZoneCfgEvent:applyZoneCfg,
+                SourceCfgEvent:applySourceCfg, VerEvent:applyVer}
+
+    def update(self, kind, num, state, changes):
+        """Applies changes to a Source or Zone and tells the listeners what actually changed"""
+        changed = {k:v for k, v in changes.items() if getattr(state, k) != v}
+        if changed:
+            state.update(changed)
+            self.version += 1
+            self.changes.record()
+            self.notify(kind, num, changed)
+        return changed
+
+    def notify(self, kind, num, changes):
+        """Calls the listeners"""
+        for listener in self.listeners:
+            try:
+                listener(kind, num, changes)
+            except Exception:
+                logging.exception("update: Listener %s failed", listener)
+
+    def indexZones(self):
+        """Rebuilds which Zone each Zone's commands go to, and the slave and group indexes"""
+        cmdZones = {}
+        slaves = {}
+        groups = {}
+        for zone, state in self.zones.items():
+            master = state.slaveto if state.slaveto in self.zones else zone
+            cmdZones[zone] = master
+            if master != zone:
+                slaves.setdefault(master, []).append(zone)
+            if state.group:
+                groups.setdefault(state.group, []).append(zone)
+        # Swapped in whole so readers on other threads never see them half built
+        self.cmdStates = {zone:self.zones[master] for zone, master in cmdZones.items()}
+        self.cmdZones = cmdZones
+        self.slaves = slaves
+        self.groups = groups
+
+    def addListener(self, listener):
+        """Calls listener('source' or 'zone', number, {field:value}) when a message changes state,
+        and listener('reset', None, {}) when the cache file replaced all of it"""
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Stops calling listener"""
+        self.listeners.remove(listener)
+
+    def changesSince(self, seq):
+        """Returns (latest sequence number, [(seq, 'zone', number, {status field:value}), ...]
+        after seq), or (latest, None) if those changes are gone and the caller must get status() again"""
+        self.changes.record()
+        return self.changes.since(seq)
+
+    def getMetrics(self):
+        """Returns the metrics as {(name, labels):value}, see Metrics.snapshot"""
+        return self.metrics.snapshot()
 
     def getStatus(self):
         """Asks the Nuvo for status of all the Sources and Zones"""
         logging.debug("getStatus...")
-        for source in self.sources.keys():
-            self.sendCommand(f'SCFG{source}STATUS?')
-        for zone in self.zones.keys():
-            self.sendCommand(f'ZCFG{zone}STATUS?')
-            self.sendCommand(f'Z{zone}STATUS?')
-            if self.getPower(zone) == 0:
-              # Zone needs to be turned on to get most of it's status
-              self.sendCommand(f'Z{zone}ON')
-              time.sleep(0.5)
-              self.sendCommand(f'Z{zone}OFF')
+        return self.refresh()
+
+    def refresh(self):
+        """Refreshes all the Sources and Zones, one pipelined batch at a time"""
+        logging.debug("refresh...")
+        self.sendCommands(self.refreshCmds(), self.backgroundPriority)
+        off = self.unknownZones()
+        if off:
+            self.sendCommands([f'Z{zone}ON' for zone in off], self.backgroundPriority)
+            if self.adaptive:
+                # The reply to ON usually has the rest of the status, ask the Zones it didn't
+                for attempt in range(self.retries):
+                    waiting = [zone for zone in off if self.getSource(zone) is None or self.getVol(zone) is None]
+                    if not waiting:
+                        break
+                    self.sendCommands([f'Z{zone}STATUS?' for zone in waiting], self.backgroundPriority)
+            else:
+                time.sleep(0.5)
+            self.sendCommands([f'Z{zone}OFF' for zone in off], self.backgroundPriority)
+
+    def refreshCmds(self):
+        """Returns the status queries for all the Sources and Zones"""
+        cmds  = [f'SCFG{source}STATUS?' for source in self.sources.keys()]
+        cmds += [f'ZCFG{zone}STATUS?' for zone in self.zones.keys()]
+        cmds += [f'Z{zone}STATUS?' for zone in self.zones.keys()]
+        return cmds
+
+    def unknownZones(self):
+        """Returns the Zones that are off and need to be turned on to get most of their status"""
+        # Unless it is already known from an earlier refresh or the cache file
+        return [zone for zone in self.zones.keys() if self.getPower(zone) == 0
+                and (self.getSource(zone) is None or self.getVol(zone) is None)]
 
     def getSourceNames(self):
         """Returns a dictionary of Source#:SourceName pairs"""    
         logging.debug("getSourceNames...")
-        return {k+1:self.sources[k+1]['name'] for k in range(self.numSources)}
+        return {k+1:self.sources[k+1].name for k in range(self.numSources)}
     
     def getZoneNames(self):
         """Returns a dictionary of Zone#:Zone Name pairs"""
         logging.debug("getZoneNames...")
-        return {k+1:self.zones[k+1]['name'] for k in range(self.numZones)}
+        return {k+1:self.zones[k+1].name for k in range(self.numZones)}
 
     def status(self):
         """Returns a dictionary of status for all Zones"""
-        for zone in self.zones.keys():
-            self.zonelist[zone]['power']      = "on" if self.getPower(zone) == 1 else "off"
-            self.zonelist[zone]['input']      = self.getSource(zone)
-            self.zonelist[zone]['input_name'] = self.getSourceName(zone)
-            self.zonelist[zone]['vol']        = self.getVol(zone)
-            self.zonelist[zone]['mute']       = "on" if self.getMute(zone) == 1 else "off"
+        # Only rebuilt when a message changed something since the last time
+        version = self.version
+        if self.statusVersion != version:
+            for zone in self.zones.keys():
+                self.zonelist[zone].update(self.zoneStatus(zone))
+            self.statusVersion = version
         return self.zonelist
 
+    def statusJson(self):
+        """Returns (version, status() as JSON), only rebuilt when the version changes"""
+        version = self.version
+        if self.statusCache is None or self.statusCache[0] != version:
+            self.statusCache = (version, json.dumps(self.status()))
+        return self.statusCache
+
+    def zoneStatus(self, zone):
+        """Returns a new dictionary of status for one Zone"""
+        state = self.cmdStates[zone]
+        return {'power':      "on" if state.power == 'ON' else "off",
+                'input':      state.source,
+                'input_name': self.sources[state.source].name if state.source is not None else "",
+                'vol':        state.volume,
+                'mute':       "on" if state.muted else "off"}
+
     def zoneInvalid(self, zone):
         """Returns True and logs a warning if Zone is not valid"""
         if zone not in self.zones.keys():
@@ -213,7 +1414,7 @@ class Nuvo:
 
     def powerInvalid(self, power):
         """Returns True and logs a warning if Power is not valid"""
-        if power not in range [0, 1]:
+        if power not in range(0, 2):
             logging.warning("%s: Power %s invalid", sys._getframe().f_back.f_code.co_name, power)
             return True
         else:
@@ -229,7 +1430,7 @@ class Nuvo:
         
     def muteInvalid(self, mute):
         """Returns True and logs a warning if Mute is not valid"""
-        if mute not in range [0, 1]:
+        if mute not in range(0, 2):
             logging.warning("%s: Mute %s invalid", sys._getframe().f_back.f_code.co_name, mute)
             return True
         else:
@@ -237,10 +1438,12 @@ class Nuvo:
 
     def getSourceName(self, zone):
         """Returns Zone's source name"""
-        if self.zoneInvalid(zone):
+        state = self.cmdStates.get(zone)
+        if state is None:
+            self.zoneInvalid(zone)
             return ""
-        if self.getSource(zone) != None:
-            return self.sources[self.getSource(zone)]['name']
+        if state.source != None:
+            return self.sources[state.source].name
         else:
             return ""
         
@@ -248,22 +1451,27 @@ class Nuvo:
         """Returns Zone's name"""
         if self.zoneInvalid(zone):
             return ""
-        return self.zones[zone]['name']
+        return self.zones[zone].name
 
     def getZoneSlave(self, zone):
         """Returns the slaved Zone if it exists or None"""
         if self.zoneInvalid(zone):
             return None
-        return self.zones[zone]['slaveto']
+        return self.zones[zone].slaveto
+
+    def getZoneSlaves(self, zone):
+        """Returns the Zones slaved to the Zone"""
+        return self.slaves.get(zone, [])
+
+    def getGroupZones(self, group):
+        """Returns the Zones in a group"""
+        return self.groups.get(group, [])
 
     def getCmdZone(self, zone):
         """Returns the Zone where the command needs to be sent"""
         if self.zoneInvalid(zone):
             return None
-        if self.getZoneSlave(zone):
-            return self.getZoneSlave(zone)
-        else:
-            return zone
+        return self.cmdZones[zone]
         
     def printZone(self, zone):
         """Prints a nicely formatted line about the Zone"""
@@ -284,14 +1492,60 @@ class Nuvo:
         """Commands the Nuvo to refresh Zone's status"""
         if self.zoneInvalid(zone):
             return
-        self.sendCommand(f'Z{zone}STATUS?')
+        return self.sendCommand(f'Z{zone}STATUS?')
+
+    def setZones(self, targets):
+        """Sets Zones to {zone:{'power':1/0, 'input':source, 'vol':volume, 'mute':1/0}},
+        sending only the commands needed to get there, and returns them.
+        Without 'power' a Zone that is not known to be on is left alone"""
+        cmds = self.zonesCmds(targets)
+        logging.debug("setZones: Sending %s", cmds)
+        self.sendCommands(cmds)
+        return cmds
+
+    def zonesCmds(self, targets):
+        """Returns the commands setZones needs to send to get to the targets"""
+        # Slaved Zones are set through their master, later Zones win
+        merged = {}
+        for zone, target in targets.items():
+            if self.zoneInvalid(zone):
+                continue
+            merged.setdefault(self.getCmdZone(zone), {}).update(target)
+        cmds = []
+        for zone, target in merged.items():
+            current = self.zones[zone]
+            if 'power' not in target:
+                # Only a Zone known to be on takes a source, volume or mute without being turned on
+                if current.power != 'ON':
+                    logging.warning("zonesCmds: Zone %s is not on, skipping %s", zone, target)
+                    continue
+            elif self.powerInvalid(target['power']):
+                continue
+            elif target['power'] == 0:
+                if current.power != 'OFF':
+                    cmds.append(f'Z{zone}OFF')
+                continue
+            elif current.power != 'ON':
+                cmds.append(f'Z{zone}ON')
+            source = target.get('input')
+            if source is not None and source != current.source and not self.sourceInvalid(source):
+                cmds.append(f'Z{zone}SRC{source}')
+            volume = target.get('vol')
+            if volume is not None and volume != current.volume and not self.volumeInvalid(volume):
+                # Convert to Nuvo's 0 = Max, 79 = Min format
+                cmds.append(f'Z{zone}VOL{79 - volume}')
+            mute = target.get('mute')
+            if mute is not None and bool(mute) != bool(current.muted) and not self.muteInvalid(mute):
+                cmds.append(f'Z{zone}MUTEON' if mute == 1 else f'Z{zone}MUTEOFF')
+        return cmds
 
     def getPower(self, zone):
         """Returnes the Zone's power status 1/0"""
-        if self.zoneInvalid(zone):
+        state = self.cmdStates.get(zone)
+        if state is None:
+            self.zoneInvalid(zone)
             return None
-        zone = self.getCmdZone(zone)
-        if self.zones[zone]['power'] == 'ON':
+        if state.power == 'ON':
             return 1
         else:
             return 0
@@ -304,20 +1558,21 @@ class Nuvo:
             return
         zone = self.getCmdZone(zone)
         if power == 1:
-            self.sendCommand(f'Z{zone}ON')
+            return self.sendCommand(f'Z{zone}ON')
         else:
-            self.sendCommand(f'Z{zone}OFF')
+            return self.sendCommand(f'Z{zone}OFF')
 
     def allOff(self):
         """Command Nuvo to turn off all Zones"""
-        self.sendCommand(f'ALLOFF')
+        return self.sendCommand(f'ALLOFF')
 
     def getSource(self, zone):
         """Returns Zone's source"""
-        if self.zoneInvalid(zone):
+        state = self.cmdStates.get(zone)
+        if state is None:
+            self.zoneInvalid(zone)
             return None
-        zone = self.getCmdZone(zone)
-        return self.zones[zone]['source']
+        return state.source
 
     def setSource(self, zone, source):
         """Commands Nuvo to set the Zone's source"""
@@ -326,46 +1581,87 @@ class Nuvo:
         if self.sourceInvalid(source):
             return
         zone = self.getCmdZone(zone)
-        self.sendCommand(f'Z{zone}SRC{source}')
+        return self.sendCommand(f'Z{zone}SRC{source}')
 
     def getVol(self, zone):
         """Returns the Zone's volume"""
-        if self.zoneInvalid(zone):
+        state = self.cmdStates.get(zone)
+        if state is None:
+            self.zoneInvalid(zone)
             return None
-        zone = self.getCmdZone(zone)
-        return self.zones[zone]['volume']
+        return state.volume
 
     def setVol(self, zone, volume):
         """Commands the Nuvo to set the Zone's volume"""
         if self.zoneInvalid(zone):
             return
-        if self.volumeInvalid(zone):
+        if self.volumeInvalid(volume):
             return
         zone = self.getCmdZone(zone)
         # Convert to Nuvo's 0 = Max, 79 = Min format
         volume = 79 - volume
-        self.sendCommand(f'Z{zone}VOL{volume}')
+        return self.sendCommand(f'Z{zone}VOL{volume}')
 
     def volUp(self, zone):
         """Commands the Nuvo to increase the Zone's volume"""
         if self.zoneInvalid(zone):
             return
         zone = self.getCmdZone(zone)
-        self.sendCommand(f'Z{zone}VOL+')
+        if self.coalesce:
+            return self.stepVol(zone, 1)
+        return self.sendCommand(f'Z{zone}VOL+')
 
     def volDown(self, zone):
         """Commands the Nuvo to decrease the Zone's volume"""
         if self.zoneInvalid(zone):
             return
         zone = self.getCmdZone(zone)
-        self.sendCommand(f'Z{zone}VOL-')
+        if self.coalesce:
+            return self.stepVol(zone, -1)
+        return self.sendCommand(f'Z{zone}VOL-')
+
+    def stepVol(self, zone, step):
+        """Adds a volume step for the Zone, all the steps within coalesce seconds are sent as one volume"""
+        with self.stepLock:
+            if zone in self.steps:
+                self.steps[zone] += step
+                return True
+            self.steps[zone] = step
+        timer = threading.Timer(self.coalesce, self.flushVol, (zone,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def flushVol(self, zone):
+        """Sends the Zone's pending volume steps as one absolute volume"""
+        with self.stepLock:
+            step = self.steps.pop(zone, 0)
+            # Start from the volume still on its way to the Nuvo, if any
+            volume = self.volTargets.get(zone, self.zones[zone].volume)
+            if volume is None:
+                target = None
+            else:
+                target = max(0, min(79, volume + step))
+                self.volTargets[zone] = target
+        if target is None:
+            # Volume not known yet, fall back to the relative commands
+            self.sendCommands([f'Z{zone}VOL+' if step > 0 else f'Z{zone}VOL-'] * abs(step))
+            return
+        logging.debug("flushVol: Zone %s %+d steps to %s", zone, step, target)
+        if target != volume:
+            # Convert to Nuvo's 0 = Max, 79 = Min format
+            self.sendCommand(f'Z{zone}VOL{79 - target}')
+        with self.stepLock:
+            if self.volTargets.get(zone) == target:
+                del self.volTargets[zone]
 
     def getMute(self, zone):
         """Returns the Zone's muted status 1/0"""
-        if self.zoneInvalid(zone):
+        state = self.cmdStates.get(zone)
+        if state is None:
+            self.zoneInvalid(zone)
             return None
-        zone = self.getCmdZone(zone)
-        if self.zones[zone]['muted']:
+        if state.muted:
             return 1
         else:
             return 0
@@ -374,17 +1670,17 @@ class Nuvo:
         """Commands the Nuvo to set the Zone's muted status"""
         if self.zoneInvalid(zone):
             return
-        if self.muteInvalid(zone):
+        if self.muteInvalid(mute):
             return
         zone = self.getCmdZone(zone)
         if mute == 1:
-            self.sendCommand(f'Z{zone}MUTEON')
+            return self.sendCommand(f'Z{zone}MUTEON')
         else:
-            self.sendCommand(f'Z{zone}MUTEOFF')
+            return self.sendCommand(f'Z{zone}MUTEOFF')
         
     def toggleMute(self, zone):
         """Commands the Nuvo to toggle the Zone's muted status"""
         if self.zoneInvalid(zone):
             return
         zone = self.getCmdZone(zone)
-        self.sendCommand(f'Z{zone}MUTE')
+        return self.sendCommand(f'Z{zone}MUTE')
@@ -0,0 +1,188 @@
+import asyncio, collections, logging, nuvo, serial_asyncio, time
+
+class AsyncNuvo(nuvo.Nuvo):
+    """asyncio version of Nuvo, commands are coroutines that return the Nuvo's reply
+
+    Parsing, validation and the getters (status, getZoneNames, getVol, ...) are
+    shared with Nuvo and stay plain methods since they never touch the port.
+    """
+
+    def __init__(self, port, to = 1, pipeline = 1, cache = None):
+        super().__init__(port, to, pipeline=pipeline, cache=cache)
+        self.stream    = None
+        self.writer    = None
+        self.readTask  = None
+        self.writeLock = asyncio.Lock()
+
+    async def __aenter__(self):
+        logging.debug("enter...")
+        await self.open()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        logging.debug("exit...")
+        await self.close()
+
+    async def open(self):
+        """Opens serial port, and updates status of all Sources and Zones"""
+        logging.debug("open...")
+        self.stream, self.writer = await serial_asyncio.open_serial_connection(
+            url=self.ser.port, baudrate=self.ser.baudrate)
+        self.readTask = asyncio.create_task(self.readLoop())
+        if await self.sendCommand(f'VER') == True:
+            self.connected = True
+            if self.loadCache():
+                self.verifier = asyncio.create_task(self.verify())
+            else:
+                await self.getStatus()
+                self.saveCache()
+            return True
+        else:
+            await self.close()
+            return False
+
+    async def close(self):
+        """Stops the reader task and closes the serial port"""
+        logging.debug("close...")
+        self.connected = False
+        if self.verifier is not None:
+            await self.verifier
+            self.verifier = None
+        if self.cached is not None:
+            self.saveCache()
+        if self.readTask is not None:
+            self.readTask.cancel()
+            self.readTask = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def verify(self):
+        """Refreshes what may have changed since the cache was saved, then saves it"""
+        logging.debug("verify...")
+        await self.refresh()
+        self.saveCache()
+
+    async def readLoop(self):
+        """Reader task: parses lines as they arrive until the port closes"""
+        while True:
+            rsp = await self.stream.readline()
+            if not rsp:
+                logging.error("readLoop: Serial port closed")
+                break
+            self.parseLine(rsp)
+
+    async def wake(self):
+        """Wakes up the Nuvo if needed"""
+        if self.asleep == True:
+            logging.debug("sendCommand: Waking Nuvo...")
+            self.metrics.inc('nuvo_wakeups_total')
+            self.writer.write(b'\r')
+            await asyncio.sleep(0.05)
+            self.asleep = False
+
+    def writeCommand(self, cmd):
+        """Writes a command to the Nuvo"""
+        logging.debug("sendCommand: Sending *%s", cmd)
+        self.writer.write(b'*' + bytes(cmd, 'ascii') + b'\r')
+
+    async def queueCommand(self, cmd):
+        """Sends a command and returns the Command whose Future is completed by the reader task"""
+        command = nuvo.Command(cmd, self.msgKey(cmd), asyncio.get_running_loop().create_future())
+        async with self.writeLock:
+            self.pending.append(command)
+            await self.wake()
+            self.writeCommand(cmd)
+            command.sent = time.monotonic()
+        return command
+
+    async def waitResponse(self, command):
+        """Waits for a queued command's reply, returns False on timeout"""
+        try:
+            return await asyncio.wait_for(command.fut, self.ser.timeout)
+        except asyncio.TimeoutError:
+            if command in self.pending:
+                self.pending.remove(command)
+            logging.warning("waitResponse: No reply to *%s", command.cmd)
+            self.metrics.inc('nuvo_reply_timeouts_total', (('command', self.cmdType(command.cmd)),))
+            return False
+
+    async def sendCommand(self, cmd):
+        """Sends the command and returns the result of parsing its reply"""
+        return (await self.sendCommands([cmd]))[0]
+
+    async def sendCommands(self, cmds):
+        """Sends commands keeping up to pipeline of them in flight, returns their results in order"""
+        results = []
+        inflight = collections.deque()
+        for cmd in cmds:
+            if len(inflight) >= self.pipeline:
+                results.append(await self.waitResponse(inflight.popleft()))
+            inflight.append(await self.queueCommand(cmd))
+        while inflight:
+            results.append(await self.waitResponse(inflight.popleft()))
+        return results
+
+    async def getStatus(self):
+        """Asks the Nuvo for status of all the Sources and Zones"""
+        logging.debug("getStatus...")
+        return await self.refresh()
+
+    async def refresh(self):
+        """Refreshes all the Sources and Zones, one pipelined batch at a time"""
+        logging.debug("refresh...")
+        await self.sendCommands(self.refreshCmds())
+        off = self.unknownZones()
+        if off:
+            await self.sendCommands([f'Z{zone}ON' for zone in off])
+            await asyncio.sleep(0.5)
+            await self.sendCommands([f'Z{zone}OFF' for zone in off])
+
+    async def setZones(self, targets):
+        """Sets Zones to their targets sending only the commands needed, and returns them"""
+        cmds = self.zonesCmds(targets)
+        logging.debug("setZones: Sending %s", cmds)
+        await self.sendCommands(cmds)
+        return cmds
+
+    async def result(self, rsp):
+        """Awaits a command started by a Nuvo method, which returns None if it was invalid"""
+        if asyncio.iscoroutine(rsp):
+            return await rsp
+        return rsp
+
+    async def queryZone(self, zone):
+        """Commands the Nuvo to refresh Zone's status"""
+        return await self.result(super().queryZone(zone))
+
+    async def setPower(self, zone, power):
+        """"Commands the Nuvo to set the Zone's power status"""
+        return await self.result(super().setPower(zone, power))
+
+    async def allOff(self):
+        """Command Nuvo to turn off all Zones"""
+        return await self.result(super().allOff())
+
+    async def setSource(self, zone, source):
+        """Commands Nuvo to set the Zone's source"""
+        return await self.result(super().setSource(zone, source))
+
+    async def setVol(self, zone, volume):
+        """Commands the Nuvo to set the Zone's volume"""
+        return await self.result(super().setVol(zone, volume))
+
+    async def volUp(self, zone):
+        """Commands the Nuvo to increase the Zone's volume"""
+        return await self.result(super().volUp(zone))
+
+    async def volDown(self, zone):
+        """Commands the Nuvo to decrease the Zone's volume"""
+        return await self.result(super().volDown(zone))
+
+    async def setMute(self, zone, mute):
+        """Commands the Nuvo to set the Zone's muted status"""
+        return await self.result(super().setMute(zone, mute))
+
+    async def toggleMute(self, zone):
+        """Commands the Nuvo to toggle the Zone's muted status"""
+        return await self.result(super().toggleMute(zone))
@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""Emulates a Nuvo Essentia NV-E6G on a pseudo-terminal
+
+Usage: nuvo_emulator.py [baudrate]
+Prints the port to give to nuvo.Nuvo and serves until interrupted.
+"""
+import logging, os, re, sys, threading, time, tty
+
+class NuvoEmulator:
+
+    #*Zx<command>
+    zonecmdre = re.compile(r'Z(?P<zone>[0-9]+)(?P<cmd>ON|OFF|STATUS\?|VOL\+|VOL-|VOL[0-9]+|'
+                           r'MUTEON|MUTEOFF|MUTE|SRC[0-9])$')
+    #*SCFGxSTATUS? / *ZCFGxSTATUS?
+    cfgcmdre = re.compile(r'(?P<cfg>SCFG|ZCFG)(?P<num>[0-9]+)STATUS\?$')
+
+    def __init__(self, numZones = 12, numSources = 6, baudrate = 57600,
+                 latency = 0.0, sleepAfter = None, wakeTime = 0.01):
+        """latency is the time the Nuvo takes to act on a command, sleepAfter is
+        the idle time after which it goes to sleep (None = only after ALLOFF),
+        and bytes received within wakeTime of waking it are lost"""
+        self.baudrate   = baudrate
+        self.latency    = latency
+        self.sleepAfter = sleepAfter
+        self.wakeTime   = wakeTime
+        self.asleep     = True
+        self.awake      = 0.0
+        self.lastRx     = time.monotonic()
+        self.received   = []
+        self.sources    = {k+1:{'enabled':True, 'name':f'Source {k+1}'} for k in range(numSources)}
+        self.zones      = {k+1:{'enabled':True, 'name':f'Zone {k+1}', 'slaveto':0, 'power':False,
+                                'source':1, 'volume':60, 'muted':False} for k in range(numZones)}
+        self.wlock      = threading.Lock()
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port       = os.ttyname(self.slave)
+        self.running    = True
+        self.thread     = threading.Thread(target=self.run, name='nuvo-emulator', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        """Stops the emulator and closes the pseudo-terminal"""
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def transmit(self, line):
+        """Sends a line to the controller, taking as long as it would at the baudrate"""
+        data = line.encode('ascii') + b'\r\n'
+        with self.wlock:
+            # 10 bits per byte: start, 8 data, stop
+            time.sleep(len(data) * 10 / self.baudrate)
+            os.write(self.master, data)
+
+    def zoneStatus(self, zone):
+        """Returns the #Z status line for a Zone"""
+        z = self.zones[zone]
+        if not z['power']:
+            return f'#Z{zone},OFF'
+        volume = 'MUTE' if z['muted'] else f"VOL{z['volume']}"
+        return f"#Z{zone},ON,SRC{z['source']},{volume},DND0,LOCK0"
+
+    def sourceConfig(self, source):
+        """Returns the #SCFG line for a Source"""
+        s = self.sources[source]
+        if not s['enabled']:
+            return f'#SCFG{source},ENABLE0'
+        return f'#SCFG{source},ENABLE1,NAME"{s["name"]}",GAIN0,NUVONET0,SHORTNAME"SRC"'
+
+    def zoneConfig(self, zone):
+        """Returns the #ZCFG line for a Zone"""
+        z = self.zones[zone]
+        if not z['enabled']:
+            return f'#ZCFG{zone},ENABLE0'
+        return (f'#ZCFG{zone},ENABLE1,NAME"{z["name"]}",SLAVETO{z["slaveto"]},'
+                f'GROUP0,SOURCES63,XSRC0,IR0,DND0,LOCKED0')
+
+    def keypad(self, zone, **state):
+        """Changes a Zone's state as if from its keypad, and sends the unsolicited #Z"""
+        self.zones[zone].update(state)
+        self.transmit(self.zoneStatus(zone))
+
+    def respond(self, cmd):
+        """Acts on a command and returns the reply"""
+        if cmd == 'VER':
+            return '#VER"NV-E6G FWv2.66 HWv0"'
+        if cmd == 'ALLOFF':
+            for z in self.zones.values():
+                z['power'] = False
+            self.asleep = True
+            return '#ALLOFF'
+        m = self.cfgcmdre.match(cmd)
+        if m:
+            num = int(m.group('num'))
+            if m.group('cfg') == 'SCFG' and num in self.sources:
+                return self.sourceConfig(num)
+            if m.group('cfg') == 'ZCFG' and num in self.zones:
+                return self.zoneConfig(num)
+            return '#?'
+        m = self.zonecmdre.match(cmd)
+        if m is None or int(m.group('zone')) not in self.zones:
+            return '#?'
+        zone = int(m.group('zone'))
+        z = self.zones[zone]
+        op = m.group('cmd')
+        if op == 'ON':
+            z['power'] = True
+        elif op == 'OFF':
+            z['power'] = False
+        elif not z['power'] or op == 'STATUS?':
+            # An off Zone ignores everything but ON
+            pass
+        elif op == 'VOL+':
+            z['volume'] = max(0, z['volume'] - 1)
+        elif op == 'VOL-':
+            z['volume'] = min(79, z['volume'] + 1)
+        elif op.startswith('VOL'):
+            z['volume'] = min(79, int(op[3:]))
+        elif op == 'MUTEON':
+            z['muted'] = True
+        elif op == 'MUTEOFF':
+            z['muted'] = False
+        elif op == 'MUTE':
+            z['muted'] = not z['muted']
+        elif op.startswith('SRC'):
+            if int(op[3:]) not in self.sources:
+                return '#?'
+            z['source'] = int(op[3:])
+        return self.zoneStatus(zone)
+
+    def receive(self, data):
+        """Handles bytes from the controller, returns the ones that were not lost waking up"""
+        now = time.monotonic()
+        if self.sleepAfter is not None and now - self.lastRx > self.sleepAfter:
+            self.asleep = True
+        self.lastRx = now
+        if self.asleep:
+            logging.debug("NuvoEmulator: Waking up")
+            self.asleep = False
+            self.awake = now + self.wakeTime
+        if now < self.awake:
+            return b''
+        return data
+
+    def run(self):
+        """Emulator thread: reads commands and replies to them"""
+        buf = b''
+        while self.running:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            buf += self.receive(data)
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                line = line.decode('ascii', 'replace').strip()
+                if not line.startswith('*'):
+                    continue
+                self.received.append(line[1:])
+                time.sleep(self.latency)
+                try:
+                    self.transmit(self.respond(line[1:]))
+                except OSError:
+                    return
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    baudrate = int(sys.argv[1]) if len(sys.argv) > 1 else 57600
+    emulator = NuvoEmulator(baudrate=baudrate)
+    print(emulator.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.close()
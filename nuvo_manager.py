@@ -0,0 +1,255 @@
+import logging, threading, json, os, serial, nuvo
+
+class NuvoManager:
+    """Several Nuvos, each on its own serial port, with their Zones numbered unit:zone
+
+    Units are numbered from 1 in the order of the ports. A Zone without a unit
+    is on unit 1, and with a single unit Zones keep their plain numbers, so a
+    one-amp install looks the same as a bare Nuvo.
+    """
+
+    def __init__(self, ports, cache = None, **kwargs):
+        """ports are the serial ports of the units, the rest is passed on to each Nuvo,
+        except that with several units they each get their own cache file"""
+        logging.debug("NuvoManager init...")
+        self.units         = {}
+        for k, port in enumerate(ports):
+            unitcache = cache
+            if cache is not None and len(ports) > 1:
+                root, ext = os.path.splitext(cache)
+                unitcache = f'{root}-{k+1}{ext}'
+            self.units[k+1] = nuvo.Nuvo(port, cache=unitcache, **kwargs)
+        self.listeners     = []
+        self.statusLock    = threading.Lock()
+        self.statusVersion = 0
+        self.statusCache   = None
+        self.changes       = nuvo.ChangeLog(nuvo.Nuvo.changeLogSize * len(self.units), self.status)
+        for unit, nv in self.units.items():
+            nv.addListener(lambda kind, num, changes, unit=unit: self.notify(unit, kind, num, changes))
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def opened(self):
+        """Whether each unit is open and has its status loaded"""
+        return {unit:nv.ready for unit, nv in self.units.items()}
+
+    def eachUnit(self, func, units = None):
+        """Calls func(unit, nv) for the open units (or the given ones) in parallel, returns their results"""
+        if units is None:
+            units = [unit for unit, opened in self.opened.items() if opened]
+        results = {}
+        def run(unit):
+            results[unit] = func(unit, self.units[unit])
+        threads = [threading.Thread(target=run, args=(unit,), name=f'nuvo-unit-{unit}') for unit in units]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def open(self):
+        """Opens the units that are not open yet, all at once, returns True if any is open"""
+        logging.debug("NuvoManager open...")
+        def openUnit(unit, nv):
+            try:
+                opened = nv.open()
+            except (serial.SerialException, OSError) as e:
+                logging.warning("open: Could not open unit %s: %s", unit, e)
+                nv.disconnect()
+                opened = False
+            if not opened:
+                logging.warning("open: Unit %s on %s is not open", unit, nv.ser.port)
+        self.eachUnit(openUnit, [unit for unit, opened in self.opened.items() if not opened])
+        return any(self.opened.values())
+
+    def connect(self):
+        """Opens the units in the background, each retrying until it answers, see Nuvo.connect"""
+        logging.debug("NuvoManager connect...")
+        for nv in self.units.values():
+            nv.connect()
+
+    def close(self):
+        """Closes all the units, also the ones still connecting"""
+        logging.debug("NuvoManager close...")
+        self.eachUnit(lambda unit, nv: nv.close(), self.units.keys())
+
+    def zoneKey(self, unit, zone):
+        """Returns the name of a unit's Zone"""
+        if len(self.units) == 1:
+            return zone
+        return f'{unit}:{zone}'
+
+    def findZone(self, zone):
+        """Returns (unit, Nuvo, zone number) for unit:zone, or (None, None, None) if it is not usable"""
+        unit, sep, num = str(zone).rpartition(':')
+        try:
+            unit = int(unit) if sep else 1
+            num = int(num)
+        except ValueError:
+            logging.warning("findZone: Zone %s invalid", zone)
+            return None, None, None
+        if unit not in self.units:
+            logging.warning("findZone: Unit %s invalid", unit)
+            return None, None, None
+        if not self.units[unit].ready:
+            logging.warning("findZone: Unit %s is not open or still loading its status", unit)
+            return None, None, None
+        return unit, self.units[unit], num
+
+    def key(self, zone):
+        """Returns the name of a Zone given as unit:zone or a number, None if it is not usable"""
+        unit, nv, num = self.findZone(zone)
+        if nv is None:
+            return None
+        return self.zoneKey(unit, num)
+
+    @property
+    def zones(self):
+        """All the Zones of all the units, by name"""
+        return {self.zoneKey(unit, zone):state for unit, nv in self.units.items()
+                for zone, state in nv.zones.items()}
+
+    def notify(self, unit, kind, num, changes):
+        """Records a unit's change and passes it on to the listeners, with the Zone's name"""
+        if kind == 'zone':
+            num = self.zoneKey(unit, num)
+        self.changes.record()
+        for listener in self.listeners:
+            try:
+                listener(kind, num, changes)
+            except Exception:
+                logging.exception("notify: Listener %s failed", listener)
+
+    def addListener(self, listener):
+        """Calls listener('source' or 'zone', number or Zone name, {field:value}) when a unit's state changes,
+        and listener('reset', None, {}) when a unit's cache file replaced all of it"""
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Stops calling listener"""
+        self.listeners.remove(listener)
+
+    def metricsSources(self):
+        """Returns each unit's metrics labelled with the unit, for Metrics.render"""
+        return [(nv.metrics, {'unit':str(unit)}) for unit, nv in self.units.items()]
+
+    def getSourceNames(self):
+        """Returns a dictionary of Source#:SourceName pairs for the first unit"""
+        return self.units[1].getSourceNames()
+
+    def getZoneNames(self):
+        """Returns a dictionary of Zone:Zone Name pairs for the open units"""
+        return {self.zoneKey(unit, zone):name for unit, nv in self.units.items() if nv.ready
+                for zone, name in nv.getZoneNames().items()}
+
+    def status(self):
+        """Returns a dictionary of status for all Zones of the open units"""
+        return {self.zoneKey(unit, zone):status for unit, nv in self.units.items() if nv.ready
+                for zone, status in nv.status().items()}
+
+    def statusJson(self):
+        """Returns (version, status() as JSON), only rebuilt when a unit's version changes"""
+        versions = tuple(nv.version if nv.ready else None for unit, nv in self.units.items())
+        with self.statusLock:
+            if self.statusCache is None or self.statusCache[0] != versions:
+                self.statusVersion += 1
+                self.statusCache = (versions, self.statusVersion, json.dumps(self.status()))
+            return self.statusCache[1:]
+
+    def changesSince(self, seq):
+        """Returns the changes of the open units after seq with Zone names, see Nuvo.changesSince,
+        a unit going down or coming back changes the Zones so the caller must resync"""
+        self.changes.record()
+        return self.changes.since(seq)
+
+    def zoneStatus(self, zone):
+        """Returns a new dictionary of status for one Zone"""
+        unit, sep, num = str(zone).rpartition(':')
+        return self.units[int(unit) if sep else 1].zoneStatus(int(num))
+
+    def setZones(self, targets):
+        """Sets Zones to their target state with Nuvo.setZones, all units at once, returns the commands sent"""
+        byUnit = {}
+        for zone, target in targets.items():
+            unit, nv, num = self.findZone(zone)
+            if nv is not None:
+                byUnit.setdefault(unit, {})[num] = target
+        results = self.eachUnit(lambda unit, nv: nv.setZones(byUnit[unit]), byUnit.keys())
+        return [cmd for unit in byUnit for cmd in results[unit]]
+
+    def allOff(self):
+        """Command all the units to turn off all Zones"""
+        return all(self.eachUnit(lambda unit, nv: nv.allOff()).values())
+
+    def forward(self, method, zone, *args):
+        """Calls a Nuvo method for a Zone on its unit"""
+        unit, nv, num = self.findZone(zone)
+        if nv is None:
+            return None
+        return getattr(nv, method)(num, *args)
+
+    def getZoneName(self, zone):
+        """Returns Zone's name"""
+        return self.forward('getZoneName', zone)
+
+    def getSourceName(self, zone):
+        """Returns Zone's source name"""
+        return self.forward('getSourceName', zone)
+
+    def printZone(self, zone):
+        """Prints a nicely formatted line about the Zone"""
+        return self.forward('printZone', zone)
+
+    def queryZone(self, zone):
+        """Commands the unit to refresh Zone's status"""
+        return self.forward('queryZone', zone)
+
+    def getPower(self, zone):
+        """Returnes the Zone's power status 1/0"""
+        return self.forward('getPower', zone)
+
+    def setPower(self, zone, power):
+        """Commands the unit to set the Zone's power status"""
+        return self.forward('setPower', zone, power)
+
+    def getSource(self, zone):
+        """Returns Zone's source"""
+        return self.forward('getSource', zone)
+
+    def setSource(self, zone, source):
+        """Commands the unit to set the Zone's source"""
+        return self.forward('setSource', zone, source)
+
+    def getVol(self, zone):
+        """Returns the Zone's volume"""
+        return self.forward('getVol', zone)
+
+    def setVol(self, zone, volume):
+        """Commands the unit to set the Zone's volume"""
+        return self.forward('setVol', zone, volume)
+
+    def volUp(self, zone):
+        """Commands the unit to increase the Zone's volume"""
+        return self.forward('volUp', zone)
+
+    def volDown(self, zone):
+        """Commands the unit to decrease the Zone's volume"""
+        return self.forward('volDown', zone)
+
+    def getMute(self, zone):
+        """Returns the Zone's muted status 1/0"""
+        return self.forward('getMute', zone)
+
+    def setMute(self, zone, mute):
+        """Commands the unit to set the Zone's muted status"""
+        return self.forward('setMute', zone, mute)
+
+    def toggleMute(self, zone):
+        """Commands the unit to toggle the Zone's muted status"""
+        return self.forward('toggleMute', zone)
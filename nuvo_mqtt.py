@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""MQTT bridge for a Nuvo or NuvoManager, needs paho-mqtt unless given a client
+
+Retained state, published when it changes:
+  <prefix>/status                'online', or 'offline' as the last will
+  <prefix>/zone/<zone>/power     'on' or 'off'
+  <prefix>/zone/<zone>/source    Source number
+  <prefix>/zone/<zone>/volume    0-79
+  <prefix>/zone/<zone>/mute      'on' or 'off'
+
+Commands:
+  <prefix>/zone/<zone>/set/power   'on', 'off', 1 or 0
+  <prefix>/zone/<zone>/set/source  Source number
+  <prefix>/zone/<zone>/set/volume  0-79, 'up' or 'down'
+  <prefix>/zone/<zone>/set/mute    'on', 'off', 1, 0 or 'toggle'
+
+Usage: nuvo_mqtt.py serial_port [broker]
+"""
+import logging, queue, sys, threading
+
+class NuvoMqtt:
+
+    # The zoneStatus key of each retained topic
+    fields = {'power':'power', 'source':'input', 'volume':'vol', 'mute':'mute'}
+
+    def __init__(self, nv, client = None, prefix = 'nuvo', host = 'localhost', port = 1883, keepalive = 60):
+        """client is a paho-mqtt Client or anything with its connect_async, loop_start, loop_stop,
+        disconnect, will_set, subscribe and publish methods and its on_connect and on_message"""
+        if client is None:
+            import paho.mqtt.client as mqtt
+            if hasattr(mqtt, 'CallbackAPIVersion'):
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            else:
+                client = mqtt.Client()
+        self.nv        = nv
+        self.client    = client
+        self.prefix    = prefix
+        self.host      = host
+        self.port      = port
+        self.keepalive = keepalive
+        self.published = {}
+        self.lock      = threading.Lock()
+        self.commands  = queue.Queue()
+        self.worker    = None
+        client.on_connect = self.onConnect
+        client.on_message = self.onMessage
+        client.will_set(f'{prefix}/status', 'offline', retain=True)
+
+    def start(self):
+        """Connects to the broker in the background, retrying while it is down, and starts
+        publishing and taking commands"""
+        logging.debug("NuvoMqtt start...")
+        self.worker = threading.Thread(target=self.workLoop, name='nuvo-mqtt', daemon=True)
+        self.worker.start()
+        self.nv.addListener(self.changed)
+        # A broker that is down must not stop the Nuvo, the network thread keeps trying
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+
+    def stop(self):
+        """Stops publishing, disconnects and waits for the commands already taken"""
+        logging.debug("NuvoMqtt stop...")
+        self.nv.removeListener(self.changed)
+        self.client.publish(f'{self.prefix}/status', 'offline', retain=True)
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.commands.put(None)
+        self.worker.join()
+
+    def onConnect(self, client, userdata, flags, *args):
+        """Subscribes to the commands and publishes all the state, also after a reconnect"""
+        logging.info("NuvoMqtt: Connected to %s:%s", self.host, self.port)
+        client.subscribe(f'{self.prefix}/zone/+/set/+')
+        client.publish(f'{self.prefix}/status', 'online', retain=True)
+        # The broker may have restarted without them
+        with self.lock:
+            self.published.clear()
+        self.publishState()
+
+    def changed(self, kind, num, changes):
+        """Nuvo listener: publishes what changed"""
+        # A change can show up in other Zones, e.g. slaved ones
+        self.publishState()
+
+    def publishState(self):
+        """Publishes each Zone's state that differs from what was last published"""
+        with self.lock:
+            for zone in self.nv.zones:
+                status = self.nv.zoneStatus(zone)
+                for field, key in self.fields.items():
+                    value = status[key]
+                    if value is None:
+                        continue
+                    topic = f'{self.prefix}/zone/{zone}/{field}'
+                    if self.published.get(topic) != value:
+                        self.published[topic] = value
+                        self.client.publish(topic, str(value), retain=True)
+
+    def onMessage(self, client, userdata, message):
+        """Takes a command, the worker thread sends it so the network thread never waits on the Nuvo"""
+        parts = message.topic.split('/')
+        if len(parts) < 4 or parts[-2] != 'set' or parts[-4] != 'zone':
+            logging.warning("NuvoMqtt: Unknown topic %s", message.topic)
+            return
+        zone = int(parts[-3]) if parts[-3].isdigit() else parts[-3]
+        self.commands.put((zone, parts[-1], message.payload.decode('utf-8', 'replace').strip().lower()))
+
+    def workLoop(self):
+        """Worker thread: sends the commands in the order they came"""
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            try:
+                self.command(*command)
+            except Exception:
+                logging.exception("NuvoMqtt: Command %s failed", command)
+
+    def onOff(self, value):
+        """Returns 1/0 for on/off, 1/0 or true/false, None otherwise"""
+        return {'on':1, '1':1, 'true':1, 'off':0, '0':0, 'false':0}.get(value)
+
+    def command(self, zone, field, value):
+        """Sends a command for a Zone, returns its result or None if it is not understood"""
+        logging.info("NuvoMqtt: Processing %s zone %s %s", field, zone, value)
+        if field == 'power' and self.onOff(value) is not None:
+            return self.nv.setPower(zone, self.onOff(value))
+        if field == 'source' and value.isdigit():
+            return self.nv.setSource(zone, int(value))
+        if field == 'volume':
+            if value == 'up':
+                return self.nv.volUp(zone)
+            if value == 'down':
+                return self.nv.volDown(zone)
+            if value.isdigit():
+                return self.nv.setVol(zone, int(value))
+        if field == 'mute':
+            if value == 'toggle':
+                return self.nv.toggleMute(zone)
+            if self.onOff(value) is not None:
+                return self.nv.setMute(zone, self.onOff(value))
+        logging.warning("NuvoMqtt: Invalid %s for zone %s: %s", field, zone, value)
+        return None
+
+if __name__ == "__main__":
+    import nuvo
+    logging.basicConfig(level=logging.INFO)
+    nv = nuvo.Nuvo(sys.argv[1], threaded=True, pipeline=4, adaptive=True, reconnect=True)
+    bridge = NuvoMqtt(nv, host=sys.argv[2] if len(sys.argv) > 2 else 'localhost')
+    nv.connect()
+    bridge.start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        bridge.stop()
+        nv.close()
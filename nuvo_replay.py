@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+"""Replays a transcript recorded with Nuvo(record=...) into a Nuvo
+
+What the Nuvo read is sent to it again on a pseudo-terminal at the recorded
+times divided by --speed (0 = as fast as possible), and the time from sending
+each read to the reader thread having parsed it is reported. With --direct the
+reads go straight to the parser, without a port, to profile parsing alone.
+"""
+import argparse, logging, nuvo, os, threading, time, tty
+from bench_nuvo import report
+
+def load(path):
+    """Returns the transcript's reads as [(seconds from its start, data)] and the number of writes"""
+    reads = []
+    writes = 0
+    start = None
+    offset = 0.0
+    for when, kind, data in nuvo.Recorder.read(path):
+        if kind == b'S':
+            # Each session has its own monotonic clock, play it right after the one before
+            start = None
+            offset = reads[-1][0] if reads else 0.0
+            continue
+        if start is None:
+            start = when
+        if kind == b'R':
+            reads.append((offset + when - start, data))
+        elif kind == b'W':
+            writes += 1
+    return reads, writes
+
+def lineEnds(reads):
+    """Returns how many lines have been completed after each read"""
+    framer = nuvo.Nuvo(None)
+    ends = []
+    total = 0
+    for when, data in reads:
+        total += len(framer.frames(data))
+        ends.append(total)
+    return ends
+
+def direct(reads):
+    """Feeds the reads to a Nuvo's parser, returns (lines, seconds)"""
+    nv = nuvo.Nuvo(None)
+    lines = 0
+    start = time.perf_counter()
+    for when, data in reads:
+        frames = nv.frames(data)
+        nv.parseLines(frames)
+        lines += len(frames)
+    return nv, lines, time.perf_counter() - start
+
+def replay(reads, speed, timeout = 10):
+    """Plays the reads to a Nuvo's reader thread on a pseudo-terminal,
+    returns (Nuvo, lines, seconds, [seconds from sending a read to it being parsed])"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    nv = nuvo.Nuvo(os.ttyname(slave), threaded=True)
+    nv.ser.open()
+
+    # Note when the reader has parsed the lines each read completes
+    ends = lineEnds(reads)
+    parsed = [0, 0]
+    done = [None] * len(reads)
+    finished = threading.Event()
+    parseLines = nv.parseLines
+    def counted(lines):
+        parseLines(lines)
+        now = time.perf_counter()
+        parsed[0] += len(lines)
+        while parsed[1] < len(ends) and ends[parsed[1]] <= parsed[0]:
+            done[parsed[1]] = now
+            parsed[1] += 1
+        if parsed[1] == len(ends):
+            finished.set()
+    nv.parseLines = counted
+    nv.startReader()
+
+    sent = []
+    start = time.perf_counter()
+    for when, data in reads:
+        if speed:
+            delay = start + when / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        sent.append(time.perf_counter())
+        os.write(master, data)
+    if not finished.wait(timeout):
+        logging.error("replay: Only %d of %d lines were parsed", parsed[0], ends[-1] if ends else 0)
+    elapsed = time.perf_counter() - start
+    nv.close()
+    os.close(master)
+    os.close(slave)
+    # Only the reads that completed a line
+    lags = [done[k] - sent[k] for k in range(len(reads))
+            if done[k] is not None and ends[k] > (ends[k-1] if k else 0)]
+    return nv, parsed[0], elapsed, lags
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('transcript', help="file written by Nuvo(record=...)")
+    parser.add_argument('--speed', type=float, default=1, help="times the recorded speed, 0 = as fast as possible")
+    parser.add_argument('--direct', action='store_true', help="feed the parser directly instead of a port")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    reads, writes = load(args.transcript)
+    print(f"{args.transcript}: {len(reads)} reads, {writes} writes, "
+          f"{reads[-1][0] if reads else 0:.1f}s recorded\n")
+    if args.direct:
+        nv, lines, elapsed = direct(reads)
+    else:
+        nv, lines, elapsed, lags = replay(reads, args.speed)
+    print(f"lines parsed:     {lines:9}")
+    print(f"state changes:    {nv.changes.seq:9}")
+    print(f"elapsed:          {elapsed:9.3f} s")
+    print(f"lines per second: {lines / elapsed if elapsed else 0:9,.0f}")
+    if not args.direct and lags:
+        print(f"\n{'measurement':24} {'count':>6} {'mean ms':>9} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        report('read to parsed', lags)
@@ -0,0 +1,281 @@
+#!/usr/bin/python3
+"""HTTP worker for nuvo_server.py, serving reads from a shared memory snapshot
+
+The server process owns the Nuvos and publishes their status and Zone names
+into shared memory. Workers share the HTTP port with SO_REUSEPORT, answer
+status and getzonelabels from the snapshot without touching that process, and
+pass every other request on to it over a unix socket.
+
+Usage (started by nuvo_server.py): nuvo_replica.py port snapshot socket run owner_pid
+"""
+import http.client, json, logging, os, socket, struct, sys, threading, time, web
+from multiprocessing import shared_memory, resource_tracker
+
+class Snapshot:
+    """Status and Zone names in shared memory, written by one process and read by many
+
+    The layout is fixed: a sequence number, then the status version, whether a
+    Nuvo is open, the lengths of the status and Zone names JSON, then both JSON.
+    The sequence number is a seqlock, odd while the writer is changing the rest,
+    so a reader copies the rest and keeps it only if the number did not change.
+    """
+
+    seq    = struct.Struct('<Q')
+    header = struct.Struct('<QQ?3xII')
+
+    # Bytes of shared memory, plenty for the JSON of several units
+    size = 1 << 16
+
+    # Seconds a read waits for a publish to finish, longer means its writer died in the middle
+    readTimeout = 1
+
+    def __init__(self, name = None):
+        """Creates the shared memory, or attaches to the one with name"""
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=self.size)
+        else:
+            self.shm = shared_memory.SharedMemory(name)
+            # Only the creator removes it, not the resource tracker of each reader when it exits
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.name    = self.shm.name
+        self.owner   = name is None
+        self.written = 0
+        self.last    = (0, (0, False, '{}', '{}'))
+
+    def publish(self, version, opened, status, names):
+        """Writes status and names, both JSON, returns False if they do not fit"""
+        status = status.encode('utf-8')
+        names = names.encode('utf-8')
+        end = self.header.size + len(status) + len(names)
+        if end > len(self.shm.buf):
+            logging.error("publish: Snapshot of %d bytes does not fit in %d", end, len(self.shm.buf))
+            return False
+        buf = self.shm.buf
+        self.seq.pack_into(buf, 0, self.written + 1)
+        self.header.pack_into(buf, 0, self.written + 1, version, opened, len(status), len(names))
+        buf[self.header.size:end] = status + names
+        self.written += 2
+        self.seq.pack_into(buf, 0, self.written)
+        return True
+
+    def read(self):
+        """Returns (version, opened, status JSON, names JSON) as last published, only copied when it changes,
+        or as last read if a publish does not finish within readTimeout"""
+        buf = self.shm.buf
+        deadline = None
+        while True:
+            seq = self.seq.unpack_from(buf, 0)[0]
+            last = self.last
+            if seq == last[0]:
+                return last[1]
+            if deadline is None:
+                deadline = time.monotonic() + self.readTimeout
+            elif time.monotonic() > deadline:
+                logging.warning("read: Snapshot %s still being written, using the last one read", self.name)
+                return last[1]
+            if seq & 1:
+                # Being written
+                time.sleep(0)
+                continue
+            written, version, opened, statusLen, namesLen = self.header.unpack_from(buf, 0)
+            end = self.header.size + statusLen + namesLen
+            data = bytes(buf[self.header.size:end]) if end <= len(buf) else None
+            if written == seq and data is not None and self.seq.unpack_from(buf, 0)[0] == seq:
+                self.last = (seq, (version, opened, data[:statusLen].decode('utf-8'),
+                                   data[statusLen:].decode('utf-8')))
+                return self.last[1]
+
+    def close(self):
+        """Detaches, and removes the shared memory if this is its creator"""
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class Publisher:
+    """Keeps a Snapshot of a NuvoManager up to date, from a thread of its own"""
+
+    # Seconds between checks for what is not notified, like a unit's link going down
+    interval = 1
+
+    def __init__(self, nv, snapshot):
+        self.nv        = nv
+        self.snapshot  = snapshot
+        self.changed   = threading.Event()
+        self.stopping  = threading.Event()
+        self.thread    = None
+        self.published = None
+
+    def start(self):
+        """Publishes now, then after each change"""
+        logging.debug("Publisher start...")
+        self.publish()
+        self.nv.addListener(self.notify)
+        self.thread = threading.Thread(target=self.publishLoop, name='nuvo-publisher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops publishing"""
+        logging.debug("Publisher stop...")
+        self.nv.removeListener(self.notify)
+        self.stopping.set()
+        self.changed.set()
+        self.thread.join()
+
+    def notify(self, kind, num, changes):
+        """Nuvo listener: wakes the publisher, a burst of changes is published once"""
+        self.changed.set()
+
+    def publishLoop(self):
+        """Publisher thread: publishes the snapshot when it changed"""
+        while not self.stopping.is_set():
+            self.changed.wait(self.interval)
+            self.changed.clear()
+            try:
+                self.publish()
+            except Exception:
+                logging.exception("publishLoop: Publishing failed")
+
+    def publish(self):
+        """Publishes the status and Zone names if they changed since the last time"""
+        opened = any(self.nv.opened.values())
+        version, status = self.nv.statusJson()
+        if self.published == (version, opened):
+            return
+        self.snapshot.publish(version, opened, status, json.dumps(self.nv.getZoneNames()))
+        self.published = (version, opened)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a unix socket"""
+
+    def __init__(self, path, timeout = 30):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+# Set by __main__
+snapshot   = None
+ownerPath  = None
+etagPrefix = None
+
+# Seconds between checks that the server process is still there
+ownerInterval = 1
+
+def watchOwner(owner):
+    """Watchdog thread: exits once the server process is gone, so an orphan does not keep the port"""
+    while os.getppid() == owner:
+        time.sleep(ownerInterval)
+    logging.error("watchOwner: Server process %d is gone, exiting", owner)
+    os._exit(1)
+
+# Each thread keeps its connection to the server process
+connections = threading.local()
+
+# Commands that go to the Nuvo, the others are answered from the snapshot
+writes = ['alloff','pwr','volup','voldwn','setvol','setinput','togglemute']
+
+# Headers passed on each way
+requestHeaders  = {'HTTP_IF_NONE_MATCH':'If-None-Match', 'CONTENT_TYPE':'Content-Type',
+                   'HTTP_LAST_EVENT_ID':'Last-Event-ID'}
+responseHeaders = ('Content-Type', 'ETag', 'Retry-After', 'Cache-Control')
+
+def forward():
+    """Passes the request on to the server process and returns its response"""
+    body = web.data() if web.ctx.method in ('POST', 'PUT') else None
+    headers = {name:web.ctx.env[key] for key, name in requestHeaders.items() if key in web.ctx.env}
+    stream = web.ctx.path == '/nuvo/events'
+    for attempt in range(2):
+        # An event stream holds its connection, the rest reuse the thread's
+        conn = UnixHTTPConnection(ownerPath, timeout=None) if stream else getattr(connections, 'conn', None)
+        reused = conn is not None and not stream
+        if conn is None:
+            conn = connections.conn = UnixHTTPConnection(ownerPath)
+        try:
+            conn.request(web.ctx.method, web.ctx.fullpath, body, headers)
+            rsp = conn.getresponse()
+            break
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            connections.conn = None
+            # The server process may have closed an idle connection, try a new one once
+            if not reused:
+                logging.warning("forward: %s %s failed: %s", web.ctx.method, web.ctx.fullpath, e)
+                raise web.HTTPError('502 Bad Gateway', data="Nuvo server not answering")
+    web.ctx.status = f'{rsp.status} {rsp.reason}'
+    for name in responseHeaders:
+        if rsp.getheader(name) is not None:
+            web.header(name, rsp.getheader(name))
+    if stream:
+        return streamFrom(conn, rsp)
+    return rsp.read()
+
+def streamFrom(conn, rsp):
+    """Yields a streamed response as it arrives"""
+    try:
+        while True:
+            data = rsp.read1()
+            if not data:
+                break
+            yield data
+    finally:
+        conn.close()
+
+urls = (
+    '/nuvo', 'controller',
+    '/.*', 'forwarder'
+)
+
+# respond to /nuvo, reading from the snapshot
+class controller:
+
+    def GET(self):
+        user_data = web.input()
+        command = user_data.command.lower() if 'command' in user_data else None
+        # status for a Zone queries the Nuvo
+        if command in writes or (command == "status" and 'zone' in user_data):
+            return forward()
+        version, opened, status, names = snapshot.read()
+        if not opened:
+            raise web.HTTPError('503 Service Unavailable',
+                                {'Content-Type':'application/json', 'Retry-After':'5'},
+                                json.dumps({'state':'connecting'}))
+        web.header('Content-Type', 'application/json')
+        if command == "getzonelabels":
+            return names
+        etag = f'"{etagPrefix}-{version}"'
+        web.header('ETag', etag)
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            raise web.notmodified()
+        return status
+
+    def POST(self):
+        return forward()
+
+# everything else goes to the server process
+class forwarder:
+
+    def GET(self):
+        return forward()
+
+    def POST(self):
+        return forward()
+
+def WSGIServer(server_address, wsgi_app):
+    """web.py's server on a port shared with the other workers, with threads for event streams"""
+    from cheroot import wsgi
+    server = wsgi.Server(server_address, wsgi_app, numthreads=10 + 32, server_name="localhost")
+    server.nodelay = True
+    server.reuse_port = True
+    return server
+
+if __name__ == "__main__":
+    port, name, ownerPath, etagPrefix, owner = sys.argv[1:6]
+    threading.Thread(target=watchOwner, args=(int(owner),), name='nuvo-watchdog', daemon=True).start()
+    snapshot = Snapshot(name)
+    web.httpserver.WSGIServer = WSGIServer
+    # Reloading would import this module again, without the settings above
+    app = web.application(urls, globals(), autoreload=False)
+    web.httpserver.runsimple(app.wsgifunc(), web.net.validaddr(port))
@@ -1,22 +1,104 @@
 #!/usr/bin/python3
-import logging, nuvo, web, time, json
+import logging, logging.handlers, nuvo, nuvo_manager, nuvo_replica, web, time, json, queue, re, threading, os, sys, subprocess, signal
 
 logfile = 'nuvo_server.log'
-serial_port = '/dev/ttyUSB0'
+# one serial port per Nuvo, with several their Zones are named unit:zone, NUVO_PORTS=port,port overrides them
+serial_ports = os.environ['NUVO_PORTS'].split(',') if 'NUVO_PORTS' in os.environ else ['/dev/ttyUSB0']
+cachefile = 'nuvo_cache.json'
+# MQTT broker to publish the Zones to and take commands from, None for no MQTT (needs paho-mqtt)
+mqttbroker = None
+# HTTP worker processes sharing the port, answering status reads from a shared memory snapshot and
+# passing the rest to this process on workersocket, 0 to answer everything here, NUVO_WORKERS overrides it
+workers = int(os.environ.get('NUVO_WORKERS', 0))
+workersocket = '/tmp/nuvo_server.sock'
 
-# set up logger
-logging.basicConfig(filename=logfile,level=logging.DEBUG,
-                    format='%(asctime)s %(levelname)s %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
+# set up logger, writing the file from its own thread so logging stays off the serial and HTTP paths
+logfileHandler = logging.FileHandler(logfile)
+logfileHandler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s',
+                                              datefmt='%Y-%m-%d %H:%M:%S'))
+logQueue = queue.Queue()
+logListener = logging.handlers.QueueListener(logQueue, logfileHandler)
+logListener.start()
+logging.basicConfig(level=logging.DEBUG, handlers=[logging.handlers.QueueHandler(logQueue)])
 
-# get the Nuvo object
-nv = nuvo.Nuvo(serial_port)
+# get the Nuvo objects
+nv = nuvo_manager.NuvoManager(serial_ports, threaded=True, pipeline=4, cache=cachefile, coalesce=0.1,
+                                 adaptive=True, reconcile=0.05, reconnect=True)
 
-# Open the Nuvo
-logging.info("Opening Nuvo at %s", serial_port)
-while nv.open() is False:
-    logging.warning("Could not open Nuvo - is it on? Retrying in 15s...")
-    time.sleep(15)
+# Open the Nuvos in the background, until then the API answers 503 "connecting"
+logging.info("Connecting to Nuvo at %s", ", ".join(serial_ports))
+nv.connect()
+
+if mqttbroker is not None:
+    import nuvo_mqtt
+    logging.info("Bridging to MQTT broker at %s", mqttbroker)
+    mqtt = nuvo_mqtt.NuvoMqtt(nv, host=mqttbroker)
+    mqtt.start()
+
+# Zone status last pushed to /nuvo/events clients, and each client's queue
+maxStreams  = 32
+keepalive   = 15
+streams     = []
+streamsLock = threading.Lock()
+laststatus  = {zone:nv.zoneStatus(zone) for zone in nv.zones}
+
+def publish(kind, num, changes):
+    """Nuvo listener: pushes the status of the Zones that changed to the stream clients"""
+    # A change can show up in other Zones, e.g. slaved ones or a Source's name
+    delta = {}
+    for zone in nv.zones:
+        status = nv.zoneStatus(zone)
+        if status != laststatus.get(zone):
+            laststatus[zone] = status
+            delta[zone] = status
+    if delta:
+        with streamsLock:
+            for q in streams:
+                q.put(delta)
+
+nv.addListener(publish)
+
+# ETags are the status version, prefixed so they differ from an earlier run's
+etagPrefix = '%x' % int(time.time())
+
+def statusResponse():
+    """Returns the status JSON, or 304 Not Modified if the client already has this version"""
+    version, payload = nv.statusJson()
+    etag = f'"{etagPrefix}-{version}"'
+    web.header('ETag', etag)
+    if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+        raise web.notmodified()
+    return payload
+
+# HTTP handler latency, served with the Nuvos' metrics on /metrics
+httpMetrics = nuvo.Metrics()
+httpMetrics.histogram('nuvo_http_request_seconds', "Time to handle an HTTP request, by path and command")
+
+def route():
+    """Returns the urls pattern the request matched, or 'other', so any path can't add a series"""
+    for pattern in urls[::2]:
+        if re.fullmatch(pattern, web.ctx.path):
+            return pattern
+    return 'other'
+
+def timeRequest(handler):
+    """web.py processor: adds the request's handling time to httpMetrics"""
+    start = time.monotonic()
+    try:
+        return handler()
+    finally:
+        labels = (('path', route()),)
+        command = web.input(_method='get').get('command', '').lower()
+        if command in commands:
+            labels += (('command', command),)
+        httpMetrics.observe('nuvo_http_request_seconds', time.monotonic() - start, labels)
+
+def requireNuvo():
+    """Answers 503 with the link state while no Nuvo is open with its status loaded"""
+    if not any(nv.opened.values()):
+        raise web.HTTPError('503 Service Unavailable',
+                            {'Content-Type':'application/json', 'Retry-After':'5'},
+                            json.dumps({'state':'connecting'}))
 
 # define list of commands we handle
 commands = ['alloff','pwr','volup','voldwn','setvol','setinput','togglemute','status','getzonelabels']
@@ -24,7 +106,11 @@ commands = ['alloff','pwr','volup','voldwn','setvol','setinput','togglemute','st
 # urls for the web app
 urls = (
     '/', 'index',
-    '/nuvo', 'controller'
+    '/nuvo', 'controller',
+    '/nuvo/events', 'events',
+    '/nuvo/batch', 'batch',
+    '/nuvo/changes', 'changes',
+    '/metrics', 'metrics'
 )
 
 # respond to /
@@ -36,6 +122,7 @@ class index:
 class controller:
 
     def GET(self):
+        requireNuvo()
         # we're going to return JSON
         web.header('Content-Type', 'application/json')
         # Grab the arguements from the URL
@@ -46,7 +133,7 @@ class controller:
         if 'command' in user_data:
             command = user_data.command.lower()
             if command in commands: 
-                zone = int(user_data.zone) if 'zone' in user_data else None
+                zone = user_data.zone if 'zone' in user_data else None
                 value = int(user_data.value) if 'value' in user_data else None
                 if zone is not None:
                     if value is not None:
@@ -104,9 +191,191 @@ class controller:
         # give the Amp time to reply 
         #time.sleep(0.5)
         
-        return json.dumps(nv.status())
+        return statusResponse()
+
+# respond to /nuvo/events with a Server-Sent Events stream of Zone status changes
+class events:
+
+    def GET(self):
+        with streamsLock:
+            if len(streams) >= maxStreams:
+                logging.warning("Too many event streams")
+                raise web.HTTPError('503 Service Unavailable', data="Too many event streams")
+            q = queue.Queue()
+            streams.append(q)
+        logging.info("Event stream opened, %d open", len(streams))
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        return self.stream(q)
+
+    def stream(self, q):
+        try:
+            # Start with the status of every Zone, then only what changed
+            yield f"data: {json.dumps(dict(laststatus))}\n\n"
+            while True:
+                try:
+                    delta = q.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(delta)}\n\n"
+        finally:
+            with streamsLock:
+                streams.remove(q)
+            logging.info("Event stream closed")
+
+# respond to /nuvo/changes?since=N&run=R with the changes after N, or with the whole status
+# and "resync" when those are gone or N is from another run of the server
+class changes:
+
+    def GET(self):
+        requireNuvo()
+        web.header('Content-Type', 'application/json')
+        user_data = web.input(since=None, run=None)
+        try:
+            since = int(user_data.since)
+        except (TypeError, ValueError):
+            since = -1
+        seq, delta = nv.changesSince(since)
+        if delta is None or (user_data.run is not None and user_data.run != etagPrefix):
+            # Changes made while this is built may also come with the next delta, they are idempotent
+            return json.dumps({'run':etagPrefix, 'seq':seq, 'resync':True, 'status':nv.status()})
+        return json.dumps({'run':etagPrefix, 'seq':seq,
+                           'changes':[{'seq':n, 'kind':kind, 'num':num, 'changes':fields}
+                                      for n, kind, num, fields in delta]})
+
+# respond to /nuvo/batch by setting many Zones with as few commands as possible
+#  POST [{"command":"pwr", "zone":3, "value":1}, {"command":"setvol", "zone":3, "value":40}, ...]
+#  POST {"3":{"power":"on", "input":2, "vol":40, "mute":"off"}, "Kitchen":{"power":"off"}, ...}
+class batch:
+
+    def POST(self):
+        requireNuvo()
+        web.header('Content-Type', 'application/json')
+        try:
+            body = json.loads(web.data())
+        except ValueError:
+            logging.warning("batch: Body is not JSON")
+            raise web.badrequest()
+        if isinstance(body, list):
+            targets = self.fromCommands(body)
+        elif isinstance(body, dict):
+            targets = self.fromState(body)
+        else:
+            logging.warning("batch: Body is not a list or an object")
+            raise web.badrequest()
+        cmds = nv.setZones(targets)
+        logging.info("batch: %d Zones set with %d commands", len(targets), len(cmds))
+        return nv.statusJson()[1]
+
+    def zoneNumber(self, zone):
+        """Returns the Zone for a number, unit:zone or Zone name"""
+        if isinstance(zone, int) or str(zone).replace(':', '').isdigit():
+            return nv.key(zone)
+        for number, name in nv.getZoneNames().items():
+            if name == zone:
+                return number
+        logging.warning("batch: Unknown Zone %s", zone)
+        return None
+
+    def onOff(self, value):
+        """Converts "on"/"off" and "1"/"0" in any case to 1/0, other values are left for setZones to reject"""
+        return {'on':1, 'off':0, '1':1, '0':0}.get(value.lower(), value) if isinstance(value, str) else value
+
+    def fromState(self, state):
+        """Returns the target state for {zone:{"power", "input", "vol", "mute"}}"""
+        targets = {}
+        for zone, target in state.items():
+            zone = self.zoneNumber(zone)
+            if zone is None or not isinstance(target, dict):
+                continue
+            targets[zone] = {k:self.onOff(v) for k, v in target.items() if k in ('power', 'input', 'vol', 'mute')}
+        return targets
+
+    def fromCommands(self, ops):
+        """Returns the target state that a list of /nuvo commands ends up in"""
+        targets = {}
+        for op in ops:
+            if not isinstance(op, dict):
+                logging.warning("batch: %s is not an object", op)
+                raise web.badrequest()
+            try:
+                value = int(op['value']) if 'value' in op else None
+            except (TypeError, ValueError):
+                logging.warning("batch: Value of %s is not a number", op)
+                raise web.badrequest()
+            command = str(op.get('command', '')).lower()
+            zone = self.zoneNumber(op['zone']) if 'zone' in op else None
+            if command == "alloff":
+                for zone in nv.zones:
+                    targets.setdefault(zone, {})['power'] = 0
+                continue
+            if command not in commands or zone is None:
+                logging.warning("batch: Skipping %s", op)
+                continue
+            target = targets.setdefault(zone, {})
+            if command == "pwr" and value is not None:
+                target['power'] = value
+            elif command == "setvol" and value is not None:
+                target['vol'] = value
+            elif command == "setinput" and value is not None:
+                target['input'] = value
+            elif command in ("volup", "voldwn"):
+                volume = target.get('vol', nv.getVol(zone))
+                if volume is not None:
+                    target['vol'] = min(79, volume + 1) if command == "volup" else max(0, volume - 1)
+            elif command == "togglemute":
+                target['mute'] = 0 if target.get('mute', nv.getMute(zone)) else 1
+            else:
+                logging.warning("batch: Skipping %s", op)
+        return targets
+
+# respond to /metrics with Prometheus text
+class metrics:
+
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return nuvo.Metrics.render([(httpMetrics, {})] + nv.metricsSources())
+
+def WSGIServer(server_address, wsgi_app):
+    """web.py's server, with a thread for each event stream on top of the usual 10"""
+    from cheroot import wsgi
+    server = wsgi.Server(server_address, wsgi_app, numthreads=10 + maxStreams, server_name="localhost")
+    server.nodelay = True
+    return server
+
+def runWorkers(app):
+    """Serves the port from worker processes, and them from this process on workersocket"""
+    snapshot = nuvo_replica.Snapshot()
+    publisher = nuvo_replica.Publisher(nv, snapshot)
+    publisher.start()
+    port = sys.argv[1] if len(sys.argv) > 1 else '8080'
+    if os.path.exists(workersocket):
+        os.remove(workersocket)
+    logging.info("Starting %d workers on %s", workers, port)
+    # Stopped like the server, so the workers go with it
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    procs = [subprocess.Popen([sys.executable, nuvo_replica.__file__, port, snapshot.name, workersocket, etagPrefix,
+                              str(os.getpid())])
+             for k in range(workers)]
+    try:
+        web.httpserver.runsimple(app.wsgifunc(), workersocket)
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        publisher.stop()
+        snapshot.close()
 
 if __name__ == "__main__":
 
-    app = web.application(urls, globals())
-    app.run()
+    web.httpserver.WSGIServer = WSGIServer
+
+    # Reloading would import this file again as a module, opening the serial ports a second time
+    app = web.application(urls, globals(), autoreload=False)
+    app.add_processor(timeRequest)
+    if workers:
+        runWorkers(app)
+    else:
+        app.run()